@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import os
+import abc
+import csv
+import json
 import time
+import datetime
 
 from ppadb.client import Client
 import openpyxl
@@ -12,16 +16,163 @@ DEVICE_IP = '192.168.0.100'
 DEVICE_PORT = 5555
 PACKAGE = 'com.android.systemui'
 
+SINK = 'xlsx'  # Sample storage: 'xlsx', 'csv' or 'jsonl'
 WORKBOOK = 'meminfo.xlsx'  # Full path
+CSV_FILE = 'meminfo.csv'  # Full path
+JSONL_FILE = 'meminfo.jsonl'  # Full path
+FLUSH_EVERY = 10  # Samples buffered before CSV/JSONL file is appended
+CHECKPOINT = 100  # Samples between checkpoint saves (0 - only at the end)
 
 TIME = 20  # Minutes of total working time
 DELAY = 3  # Seconds between requests
 
+HEADER = 'RAM used, K'
+
 
 def ts():
     return int(time.time())
 
 
+class Sink(abc.ABC):
+    """Storage of samples. Samples are kept in buffer and written by
+    flush(), which is called every `flush_every` samples and on close.
+    Subclasses implement write().
+    """
+
+    def __init__(self, path, run, flush_every):
+        """
+        :param path: output file path
+        :param run: run ID (sheet name in workbook)
+        :param flush_every: number of samples buffered before flush
+        """
+        self.path = path
+        self.run = run
+        self.flush_every = flush_every
+        self.buffer = []
+
+    def add(self, timestamp, value):
+        """Store sample
+
+        :param timestamp: POSIX timestamp of sample
+        :param value: sample value
+        """
+        self.buffer.append((timestamp, value))
+        if self.flush_every and len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write buffered samples"""
+        if self.buffer:
+            self.write(self.buffer)
+            self.buffer = []
+
+    @abc.abstractmethod
+    def write(self, samples):
+        """Write samples to storage
+
+        :param samples: list of tuples with POSIX timestamp and value
+        """
+
+    def close(self):
+        """Write remaining buffered samples"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class CsvSink(Sink):
+    """Samples are appended to CSV file: run ID, time, value"""
+
+    def write(self, samples):
+        new = not os.path.isfile(self.path)
+        with open(self.path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(('run', 'time', HEADER))
+            writer.writerows((self.run, _isotime(t), v) for t, v in samples)
+
+
+class JsonlSink(Sink):
+    """Samples are appended to JSON Lines file"""
+
+    def write(self, samples):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps({'run': self.run, 'time': _isotime(t),
+                                     'value': v}) + '\n'
+                         for t, v in samples)
+
+
+class XlsxSink(Sink):
+    """Samples are written to new sheet of workbook (placed first) on close.
+    At checkpoints samples of the run are saved to separate checkpoint file
+    (workbook path with run ID suffix), so workbook with previous runs is
+    loaded and saved only once and keeps its formatting.
+    """
+
+    def __init__(self, path, run, flush_every):
+        super().__init__(path, run, flush_every)
+        self.rows = []
+        self.checkpoint = f'{os.path.splitext(path)[0]}.{run}.xlsx'
+
+    def write(self, samples):
+        self.rows.extend((datetime.datetime.fromtimestamp(t), v)
+                         for t, v in samples)
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(self.run)
+        ws.append(('Time', HEADER))
+        for row in self.rows:
+            ws.append(row)
+        # Keep file valid if script is interrupted while saving
+        wb.save(self.checkpoint + '.tmp')
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    def close(self):
+        """Merge samples of the run into workbook"""
+        self.rows.extend((datetime.datetime.fromtimestamp(t), v)
+                         for t, v in self.buffer)
+        self.buffer = []
+        if os.path.isfile(self.path):
+            wb = openpyxl.load_workbook(self.path)
+        else:
+            wb = openpyxl.Workbook()
+        ws = wb.create_sheet(self.run, 0)
+        ws.append(('Time', HEADER))
+        for row in self.rows:
+            ws.append(row)
+        wb.save(self.path + '.tmp')
+        wb.close()
+        os.replace(self.path + '.tmp', self.path)
+        if os.path.isfile(self.checkpoint):
+            os.remove(self.checkpoint)
+
+
+def _isotime(timestamp):
+    """Format POSIX timestamp as local ISO 8601 time (seconds)"""
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(
+        timespec='seconds')
+
+
+def open_sink(kind, run):
+    """Create sample storage
+
+    :param kind: 'xlsx', 'csv' or 'jsonl'
+    :param run: run ID
+
+    :return: Sink instance
+    """
+    if kind == 'xlsx':
+        return XlsxSink(WORKBOOK, run, CHECKPOINT)
+    if kind == 'csv':
+        return CsvSink(CSV_FILE, run, FLUSH_EVERY)
+    if kind == 'jsonl':
+        return JsonlSink(JSONL_FILE, run, FLUSH_EVERY)
+    raise ValueError(f'Unknown sink: {kind}')
+
+
 if __name__ == '__main__':
     # Start server and connect to device
     os.system('adb start-server')
@@ -35,34 +186,26 @@ if __name__ == '__main__':
         exit(1)
     device = client.device(f'{DEVICE_IP}:{DEVICE_PORT}')
 
-    # Prepare workbook
-    if os.path.isfile(WORKBOOK):
-        wb = openpyxl.load_workbook(WORKBOOK)
-        print(f'Open {WORKBOOK}')
-    else:
-        wb = openpyxl.Workbook()
-        wb.save(WORKBOOK)
-        print(f'Create {WORKBOOK}')
-    ws = wb.create_sheet(str(ts()), 0)
-    b1 = 'RAM used, K'
-    row = 2
+    # Prepare sample storage
+    sink = open_sink(SINK, str(ts()))
+    print(f'Write samples to {sink.path}')
 
     # Collect data
     print(f'Starting to collect data for {PACKAGE}')
-    print('{:>15}'.format(b1))
-    wtime = TIME * 60
-    while wtime > 0:
-        raw = device.shell(f'dumpsys meminfo | grep {PACKAGE}')
-        result = int(raw.strip().split('K')[0].replace(',', ''))
-        ws.cell(row=row, column=1, value=result)
-        wb.save(WORKBOOK)
-        print('{:>15}'.format(result))
-        time.sleep(DELAY)
-        row += 1
-        wtime -= DELAY
+    print('{:>15}'.format(HEADER))
+    start = time.monotonic()
+    samples = -(-TIME * 60 // DELAY)
+    with sink:
+        for n in range(samples):
+            raw = device.shell(f'dumpsys meminfo | grep {PACKAGE}')
+            result = int(raw.strip().split('K')[0].replace(',', ''))
+            sink.add(time.time(), result)
+            print('{:>15}'.format(result))
+            # Sleep until next sample is due, so sampling does not drift
+            if n + 1 < samples:
+                time.sleep(max(0, start + (n + 1) * DELAY - time.monotonic()))
     print('All done.')
 
     # Close connection and exit
-    wb.close()
     client.remote_disconnect()
     client.kill()
@@ -1,13 +1,48 @@
 from typing import Union
 import re
+import time
+import base64
+import quopri
+import imaplib
 import logging
+import threading
+import contextlib
+import collections
 import imapclient
-import email
 import keyring
 
 
 log = logging.getLogger(__name__)
 
+IDLE_RENEW = 300  # Seconds after which IDLE is reissued (RFC 2177: < 29 min)
+BODY_LIMIT = 65536  # Maximum number of fetched bytes of message part
+RECOVERY_LINK = re.compile(r'href="(\S+sendgrid\S+)" target')
+# Errors after which IMAP connection can not be reused
+CONNECTION_ERRORS = (OSError, imaplib.IMAP4.error)
+
+_passwords = {}
+_passwords_lock = threading.Lock()
+
+
+def get_password(username: str) -> Union[str, None]:
+    """Get password from local keyring storage.
+    Password is cached in process memory, so keyring backend is queried
+    once per user.
+
+    :param username: user's name / e-mail address
+    :type username: str
+
+    :return: password or None if it is not stored
+    :rtype: str
+    """
+    with _passwords_lock:
+        password = _passwords.get(username)
+        if password is None:
+            password = keyring.get_password('system', username)
+            if password is not None:
+                _passwords[username] = password
+    return password
+
 
 class EmailClient:
     """Client for e-mail processing.
@@ -15,51 +50,158 @@ class EmailClient:
 
     :ivar client: e-mail client instance
     :ivar current_folder: current selected folder in mailbox
+    :ivar uid_validity: UIDVALIDITY of current folder
+    :ivar criteria: header search criteria of recovery mail
+    :ivar text: text of recovery mail for full-text search
     """
 
-    def __init__(self, host: str, port: int = 993):
+    def __init__(self, host: str, port: int = 993,
+                 criteria: Union[list, None] = None,
+                 text: Union[str, None] = 'sendgrid'):
         """
         :param host: IMAP server
         :type host: str
 
         :param port: IMAP port (993 by default)
         :type port: int
+
+        :param criteria: header search criteria of recovery mail, e.g.
+                         ['FROM', 'noreply@example.com', 'SUBJECT',
+                         'password'] (None by default)
+        :type criteria: list
+
+        :param text: text of recovery mail for full-text search, which is
+                     used if header criteria are not given or found nothing
+                     ('sendgrid' by default, None to disable)
+        :type text: str
         """
         self.client = imapclient.IMAPClient(host, port, ssl=True)
         self.current_folder = None
+        self.uid_validity = None
+        self.criteria = list(criteria or [])
+        self.text = text
+        # Highest seen UID and latest recovery mail UID
+        # per (folder, UIDVALIDITY)
+        self._last_uid = {}
+        self._latest = {}
+        # Recovery links per (folder, UIDVALIDITY) and UID
+        self._links = {}
 
     def login(self, username: str):
         """Perform log-in to IMAP server.
-        Password is retrieved automatically from local keyring storage.
+        Password is retrieved automatically from local keyring storage
+        (see get_password()).
 
         :param username: user's name / e-mail address
         :type username: str
         """
-        self.client.login(username, keyring.get_password('system', username))
+        self.client.login(username, get_password(username))
 
     def logout(self):
         """Perform log-out from IMAP server.
         """
         self.client.logout()
 
+    def select_folder(self, folder: str):
+        """Select folder unless it is already selected.
+
+        :param folder: folder name
+        :type folder: str
+        """
+        if self.current_folder != folder:
+            response = self.client.select_folder(folder)
+            self.current_folder = folder
+            self.uid_validity = response.get(b'UIDVALIDITY')
+            log.info(f'Go to {folder}')
+
     def find_recovery_mail(self) -> Union[int, None]:
         """Search for latest password recovery mail.
+        Only mail which arrived since previous search (and previously found
+        recovery mail) is searched: highest seen UID is kept per folder and
+        UIDVALIDITY. Header criteria are tried first, full-text search is
+        a fallback.
 
         :return: mail's UID
         :rtype: int
         """
         inbox = 'INBOX'
-        if self.current_folder != inbox:
-            self.client.select_folder(inbox)
-            self.current_folder = inbox
-            log.info(f'Go to {inbox}')
-        try:
-            uid = max(self.client.search(['UNSEEN', 'TEXT', 'sendgrid']))
+        self.select_folder(inbox)
+        key = (inbox, self.uid_validity)
+        last = self._last_uid.get(key, 0)
+        # UID range n:* always includes the last message, even if its UID
+        # is less than n (RFC 3501)
+        new = [u for u in self.client.search(['UID', f'{last + 1}:*'])
+               if u > last]
+        if new:
+            self._last_uid[key] = max(new)
+        start = self._latest.get(key) or last + 1
+        uid = None
+        if new or self._latest.get(key):
+            window = ['UID', f'{start}:*', 'UNSEEN']
+            found = []
+            if self.criteria:
+                found = self.client.search(window + self.criteria)
+            if not found and self.text:
+                found = self.client.search(window + ['TEXT', self.text])
+            found = [u for u in found if u >= start]
+            uid = max(found) if found else None
+        self._latest[key] = uid
+        if uid is not None:
             log.info(f'Found latest recovery mail: UID #{uid}')
-        except ValueError:
-            uid = None
         return uid
 
+    def wait_for_recovery_mail(self, timeout: float = 60,
+                               interval: float = 5) -> Union[int, None]:
+        """Wait for password recovery mail.
+        Client is notified of new mail with IMAP IDLE, so mail is found as
+        soon as it lands; if server does not support IDLE, mailbox is polled.
+
+        :param timeout: maximum waiting time, seconds (60 by default)
+        :type timeout: float
+
+        :param interval: polling interval without IDLE, seconds
+                         (5 by default)
+        :type interval: float
+
+        :return: mail's UID or None if no mail arrived in time
+        :rtype: int
+        """
+        deadline = time.monotonic() + timeout
+        uid = self.find_recovery_mail()
+        idle = self.client.has_capability('IDLE')
+        if not idle:
+            log.info('IDLE is not supported, polling mailbox')
+        while uid is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning(f'No recovery mail in {timeout} s')
+                break
+            if not idle:
+                time.sleep(min(interval, remaining))
+            # New mail reported with responses to previous commands (e.g.
+            # SEARCH) is not reported by IDLE again
+            elif not self._pending_exists():
+                self.client.idle()
+                responses = []
+                try:
+                    responses = self.client.idle_check(
+                        timeout=min(remaining, IDLE_RENEW))
+                finally:
+                    responses += self.client.idle_done()[1]
+                if not any(len(r) > 1 and r[1] == b'EXISTS'
+                           for r in responses):
+                    continue
+            uid = self.find_recovery_mail()
+        return uid
+
+    def _pending_exists(self) -> bool:
+        """Check for EXISTS responses kept by imaplib since last check.
+
+        :return: True if server reported new number of messages
+        :rtype: bool
+        """
+        return bool(self.client._imap.untagged_responses.pop('EXISTS', None))
+
     def get_recovery_link(self, uid: int) -> Union[str, None]:
         """Extract URL for password recovery from e-mail message.
 
@@ -69,14 +211,297 @@ class EmailClient:
         :return: password recovery URL
         :rtype: str
         """
-        data = self.client.fetch(uid, 'RFC822')
-        raw_msg = data[uid]
-        decoded_msg = email.message_from_bytes(raw_msg[b'RFC822'])
-        body = str(decoded_msg.get_payload(decode=True))
+        return self.get_recovery_links([uid])[uid]
+
+    def get_recovery_links(self, uids: list,
+                           limit: int = BODY_LIMIT) -> dict:
+        """Extract URLs for password recovery from several e-mail messages.
+        Only message structure and the first bytes of its HTML (or plain
+        text) part are fetched, for all messages at once. Messages are
+        marked as seen. Links are cached by UID, so repeated lookups do not
+        touch server.
+
+        :param uids: mail UIDs
+        :type uids: list
+
+        :param limit: maximum number of fetched bytes of message part
+                      (BODY_LIMIT by default)
+        :type limit: int
+
+        :return: dict with password recovery URL (or None) per UID
+        :rtype: dict
+        """
+        key = (self.current_folder, self.uid_validity)
+        cache = self._links.setdefault(key, {})
+        missing = [uid for uid in uids if uid not in cache]
+        if missing:
+            sections = {}
+            structures = self.client.fetch(missing, ['BODYSTRUCTURE'])
+            for uid in missing:
+                part = _text_part(structures[uid][b'BODYSTRUCTURE']) \
+                    if uid in structures else None
+                if part is None:
+                    log.warning(f'No text part in #{uid}')
+                    cache[uid] = None
+                else:
+                    sections.setdefault(part[0], []).append((uid, part))
+            for section, parts in sections.items():
+                item = f'BODY.PEEK[{section}]<0.{limit}>'
+                data = self.client.fetch([uid for uid, _ in parts], [item])
+                for uid, (_, encoding, charset, _) in parts:
+                    body = next((v for k, v in data.get(uid, {}).items()
+                                 if k.startswith(b'BODY[')), b'')
+                    cache[uid] = _find_link(
+                        _decode(body, encoding, charset), uid)
+            self.client.add_flags(missing, [imapclient.SEEN])
+        return {uid: cache[uid] for uid in uids}
+
+
+class EmailClientPool:
+    """Bounded pool of logged in e-mail clients, which can be shared by
+    threads. Every client is one IMAP connection with its own selected
+    folder and search state. Clients idle for a while are checked with NOOP
+    before being lent, broken ones are replaced.
+
+        pool = EmailClientPool('imap.example.com', 'user@example.com')
+        with pool.connection() as client:
+            uid = client.wait_for_recovery_mail()
+
+    :ivar size: maximum number of connections
+    :ivar check_idle: idle time after which connection is checked, seconds
+    """
+
+    def __init__(self, host: str, username: str, port: int = 993,
+                 size: int = 4, check_idle: float = 10, **kwargs):
+        """
+        :param host: IMAP server
+        :type host: str
+
+        :param username: user's name / e-mail address
+        :type username: str
+
+        :param port: IMAP port (993 by default)
+        :type port: int
+
+        :param size: maximum number of connections (4 by default)
+        :type size: int
+
+        :param check_idle: idle time after which connection is checked with
+                           NOOP before being lent, seconds (10 by default)
+        :type check_idle: float
+
+        :param kwargs: other EmailClient arguments (criteria, text)
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.size = size
+        self.check_idle = check_idle
+        self._kwargs = kwargs
+        # Idle clients with time of release, most recently used last
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def _connect(self) -> EmailClient:
+        """Open new connection and log in.
+
+        :return: e-mail client
+        :rtype: EmailClient
+        """
+        client = EmailClient(self.host, self.port, **self._kwargs)
+        client.login(self.username)
+        log.info(f'Pool: connected to {self.host}')
+        return client
+
+    @staticmethod
+    def _healthy(client: EmailClient) -> bool:
+        """Check connection with NOOP.
+
+        :param client: e-mail client
+        :type client: EmailClient
+
+        :return: True if connection works
+        :rtype: bool
+        """
+        try:
+            client.client.noop()
+            return True
+        except CONNECTION_ERRORS as e:
+            log.warning(f'Pool: connection is broken: {e}')
+            return False
+
+    @staticmethod
+    def _discard(client: EmailClient):
+        """Close connection ignoring errors.
+
+        :param client: e-mail client
+        :type client: EmailClient
+        """
+        try:
+            client.logout()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: Union[float, None] = None) -> EmailClient:
+        """Borrow logged in client. Client must be given back with
+        release().
+
+        :param timeout: maximum waiting time for free connection, seconds
+                        (None by default, wait forever)
+        :type timeout: float
+
+        :return: e-mail client
+        :rtype: EmailClient
+
+        :raise RuntimeError if pool is closed
+        :raise TimeoutError if no connection is free in time
+        """
+        if self._closed:
+            raise RuntimeError('Pool is closed')
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f'No free IMAP connection in {timeout} s')
+        try:
+            while True:
+                with self._lock:
+                    client, released = self._idle.pop() if self._idle \
+                        else (None, None)
+                if client is None:
+                    return self._connect()
+                if time.monotonic() - released < self.check_idle or \
+                        self._healthy(client):
+                    return client
+                self._discard(client)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, client: EmailClient, discard: bool = False):
+        """Give back borrowed client.
+
+        :param client: e-mail client
+        :type client: EmailClient
+
+        :param discard: close connection instead of reusing it
+                        (False by default)
+        :type discard: bool
+        """
         try:
-            r = re.search(r'href="(\S+sendgrid\S+)" target', body).group(1)
-            log.info(f'Found password recovery link: {r}')
-        except AttributeError:
-            log.warning(f'Password recovery link was not found in #{uid}')
-            r = None
-        return r
+            if discard or self._closed:
+                self._discard(client)
+            else:
+                with self._lock:
+                    self._idle.append((client, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout: Union[float, None] = None):
+        """Borrow logged in client for with-block. Connection is closed if
+        block fails with connection error.
+
+        :param timeout: maximum waiting time for free connection, seconds
+                        (None by default, wait forever)
+        :type timeout: float
+        """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            self.release(client, discard=True)
+            raise
+        except BaseException:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def close(self):
+        """Log out idle connections; borrowed ones are closed when released.
+        """
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for client, _ in idle:
+            self._discard(client)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _text_part(structure, section: str = '') -> Union[tuple, None]:
+    """Find HTML part (or plain text part) of message.
+
+    :param structure: BODYSTRUCTURE of message or its part
+    :param section: section number of given part
+
+    :return: tuple with section number, transfer encoding, charset and
+             HTML flag or None if there is no text part
+    :rtype: tuple
+    """
+    if isinstance(structure[0], list):
+        parts = [_text_part(p, f'{section}.{n}'.lstrip('.'))
+                 for n, p in enumerate(structure[0], 1)]
+        parts = [p for p in parts if p is not None]
+        # Prefer HTML part, which contains link in href attribute
+        parts.sort(key=lambda p: not p[3])
+        return parts[0] if parts else None
+    if structure[0].lower() != b'text' or \
+            structure[1].lower() not in (b'html', b'plain'):
+        return None
+    params = list(structure[2] or [])
+    # Parameter names are case-insensitive (RFC 2045)
+    charset = {k.upper(): v for k, v in zip(params[::2], params[1::2])}.get(
+        b'CHARSET', b'utf-8')
+    return (section or '1', (structure[5] or b'7bit').lower().decode(),
+            charset.decode(), structure[1].lower() == b'html')
+
+
+def _decode(body: bytes, encoding: str, charset: str) -> str:
+    """Decode message part, which may be truncated.
+
+    :param body: content of message part
+    :type body: bytes
+
+    :param encoding: content transfer encoding
+    :type encoding: str
+
+    :param charset: charset of message part
+    :type charset: str
+
+    :return: decoded text
+    :rtype: str
+    """
+    if encoding == 'base64':
+        body = b''.join(body.split())
+        body = base64.b64decode(body[:len(body) // 4 * 4])
+    elif encoding == 'quoted-printable':
+        body = quopri.decodestring(body)
+    try:
+        return body.decode(charset, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+def _find_link(body: str, uid: int) -> Union[str, None]:
+    """Find password recovery URL in message text.
+
+    :param body: message text
+    :type body: str
+
+    :param uid: mail's UID
+    :type uid: int
+
+    :return: password recovery URL
+    :rtype: str
+    """
+    m = RECOVERY_LINK.search(body)
+    if m is None:
+        log.warning(f'Password recovery link was not found in #{uid}')
+        return None
+    log.info(f'Found password recovery link: {m.group(1)}')
+    return m.group(1)
@@ -2,8 +2,252 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import time
 import random
+import hashlib
 import logging
+from concurrent import futures
+
+
+BLOCK_SIZE = 2**22  # Size of content block generated and written at once
+MODES = ('digits', 'random', 'zeros', 'sparse', 'preallocated')
+BATCH_FILES = 256  # Number of files written by one pool task
+
+# Random bytes 0..249 are mapped to ASCII digits evenly, 250..255 are dropped
+_DIGITS = bytes.maketrans(bytes(range(250)),
+                          bytes(0x30 + b % 10 for b in range(250)))
+_NOT_DIGITS = bytes(range(250, 256))
+
+
+def digits(size, randbytes=os.urandom):
+    """Get random ASCII digits
+
+    :param size: number of digits
+    :param randbytes: function returning given number of random bytes
+                      (default = os.urandom)
+
+    :return: bytes with digits
+    """
+    data = randbytes(size + size // 32 + 16).translate(_DIGITS, _NOT_DIGITS)
+    while len(data) < size:
+        data += randbytes(size - len(data) + 16).translate(_DIGITS,
+                                                           _NOT_DIGITS)
+    return data[:size]
+
+
+def blocks(size, mode='digits', block_size=BLOCK_SIZE, randbytes=os.urandom):
+    """Generate file content block by block
+
+    :param size: content size in bytes
+    :param mode: content mode: 'digits' (random ASCII digits), 'random'
+                 (random bytes) or 'zeros'
+    :param block_size: maximum block size in bytes
+    :param randbytes: function returning given number of random bytes
+                      (default = os.urandom)
+
+    :return: bytes-like blocks
+
+    :raise ValueError if mode is unknown
+    """
+    if mode == 'digits':
+        def make(n):
+            return digits(n, randbytes)
+    elif mode == 'random':
+        make = randbytes
+    elif mode == 'zeros':
+        zeros = memoryview(bytes(min(size, block_size)))
+
+        def make(n):
+            return zeros[:n]
+    else:
+        raise ValueError('Unknown content mode: {}'.format(mode))
+    for pos in range(0, size, block_size):
+        yield make(min(block_size, size - pos))
+
+
+def write_content(f, size, mode='digits', block_size=BLOCK_SIZE,
+                  randbytes=os.urandom, digest=None):
+    """Write content to binary file
+
+    :param f: binary file object opened for writing
+    :param size: content size in bytes
+    :param mode: content mode: 'digits', 'random', 'zeros', 'sparse' (file
+                 with a hole, no data is written) or 'preallocated' (disk
+                 space is allocated without writing, where supported;
+                 otherwise zeros are written)
+    :param block_size: maximum block size in bytes
+    :param randbytes: function returning given number of random bytes
+                      (default = os.urandom)
+    :param digest: hashlib object updated with written content, so file
+                   does not have to be read again to get its hash
+
+    :raise ValueError if mode is unknown
+    """
+    if mode in ('sparse', 'preallocated'):
+        if mode == 'sparse':
+            f.truncate(size)
+        elif size and hasattr(os, 'posix_fallocate'):
+            f.flush()
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            mode = 'zeros'
+        if mode != 'zeros':
+            if digest is not None:
+                for block in blocks(size, 'zeros', block_size):
+                    digest.update(block)
+            return
+    for block in blocks(size, mode, block_size, randbytes):
+        f.write(block)
+        if digest is not None:
+            digest.update(block)
+
+
+def file_seed(seed, name):
+    """Get seed of content stream of one file, so every file is
+    reproducible regardless of order and process it is generated in
+
+    :param seed: seed of file set
+    :param name: file path relative to file set directory
+
+    :return: file seed or None if seed is None
+    """
+    return None if seed is None else '{}:{}'.format(seed, name)
+
+
+def seeded_randbytes(seed):
+    """Get reproducible source of random bytes (Random.randbytes() is
+    available since Python 3.9 only)
+
+    :param seed: seed of random generator
+
+    :return: function returning given number of random bytes
+    """
+    rng = random.Random(seed)
+
+    def randbytes(n):
+        return rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+    return randbytes
+
+
+def file_digest(path, algorithm, block_size=BLOCK_SIZE):
+    """Hash existing file
+
+    :param path: file path
+    :param algorithm: name of hashlib algorithm
+    :param block_size: size of a single read, bytes
+
+    :return: hex digest of file content
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save_manifest(path, entries, seed=None, algorithm='sha256',
+                  block_size=BLOCK_SIZE):
+    """Write manifest of generated files (JSON)
+
+    :param path: manifest file path
+    :param entries: list of dicts with file path (relative to file set
+                    directory), size, content mode and digest
+    :param seed: seed of file set
+    :param algorithm: hash algorithm of digests
+    :param block_size: block size content was generated with
+    """
+    with open(path, 'wt', encoding='utf-8') as f:
+        json.dump({'seed': seed, 'algorithm': algorithm,
+                   'block_size': block_size,
+                   'files': sorted(entries, key=lambda e: e['path'])},
+                  f, indent=2)
+    logging.info('Manifest saved: {}'.format(path))
+
+
+def load_manifest(path):
+    """Read manifest of generated files
+
+    :param path: manifest file path
+
+    :return: dict with seed, algorithm, block size and list of files
+    """
+    with open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_file(path, size, mode='digits', fsync=False, seed=None,
+               algorithm=None, block_size=BLOCK_SIZE):
+    """Create one file with generated content
+
+    :param path: file path
+    :param size: file size in bytes
+    :param mode: content mode (see write_content())
+    :param fsync: flush file to disk before closing (default = False)
+    :param seed: seed of file content (default = None, system entropy)
+    :param algorithm: name of hashlib algorithm to hash content with
+                      (default = None, no hashing)
+    :param block_size: size of content block
+
+    :return: hex digest of content ('' without algorithm) or None on error
+             (error is logged)
+    """
+    try:
+        f = open(path, 'xb')
+    except FileExistsError:
+        logging.error('Fail - {} - file already exists'.format(path))
+        return None
+    except IOError as e:
+        logging.error('Fail - {} - {}'.format(path, e))
+        return None
+    randbytes = os.urandom if seed is None else seeded_randbytes(seed)
+    digest = hashlib.new(algorithm) if algorithm else None
+    with f:
+        write_content(f, size, mode, block_size, randbytes, digest)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    return digest.hexdigest() if digest is not None else ''
+
+
+def _write_batch(tasks, fsync, algorithm):
+    """Create batch of files (pool task)
+
+    :param tasks: list of tuples with file path, name (path relative to file
+                  set directory), size, content mode and seed
+    :param fsync: flush files to disk
+    :param algorithm: name of hashlib algorithm or None
+
+    :return: list of manifest entries of created files
+    """
+    entries = []
+    for path, name, size, mode, seed in tasks:
+        digest = write_file(path, size, mode, fsync, seed, algorithm)
+        if digest is not None:
+            entry = {'path': name, 'size': size, 'mode': mode}
+            if algorithm:
+                entry[algorithm] = digest
+            entries.append(entry)
+    return entries
+
+
+def tree(root, fanout=0, depth=0):
+    """Get leaf directories of a directory tree
+
+    :param root: tree root
+    :param fanout: number of subdirectories of every directory
+    :param depth: number of directory levels below root
+
+    :return: list of leaf directory paths (root itself for flat tree)
+    """
+    leaves = [root]
+    if fanout < 1:
+        return leaves
+    width = len(str(fanout - 1))
+    for _ in range(depth):
+        leaves = [os.path.join(leaf, '{:0{}d}'.format(n, width))
+                  for leaf in leaves for n in range(fanout)]
+    return leaves
 
 
 class FileGenerator:
@@ -40,16 +284,26 @@ class FileGenerator:
                 raise Exception('Path does not exist and autocreation flag '
                                 'is {}: {}'.format(create, self.path))
 
-    def generate(self, size, files):
+    def generate(self, size, files, mode='digits', seed=None, manifest=None,
+                 algorithm='sha256'):
         """Function to create files with random data (random integers from 0
-        to 9)
+        to 9 by default). Content is generated and written in large blocks.
 
         :param size: file size in bytes
         :param files: number of files
+        :param mode: content mode (see MODES and write_content())
+                     (default = 'digits')
+        :param seed: seed for reproducible content; every file gets its own
+                     stream (see file_seed()) (default = None, not
+                     reproducible)
+        :param manifest: path of manifest to write (default = None)
+        :param algorithm: hashlib algorithm of manifest digests
+                          (default = 'sha256')
 
         :raise ValueError:
                    - file size < 0
                    - number of files < 1
+                   - unknown content mode
         :raise IOError on file opening error
         :raise FileExistsError if file already exists
         """
@@ -64,23 +318,167 @@ class FileGenerator:
             logging.error('Files number should be > 0, not {}'.format(_files))
             raise ValueError(
                 'Files number should be > 0, not {}'.format(_files))
-        random.seed()
+        if mode not in MODES:
+            logging.error('Unknown content mode: {}'.format(mode))
+            raise ValueError('Unknown content mode: {}'.format(mode))
         logging.info('Generating files')
+        entries = []
         for n in range(_files):
-            _file = os.path.join(self.path, '{}-{}B'.format(n, _size))
-            try:
-                f = open(_file, 'x', encoding='utf-8')
-            except IOError as e:
-                logging.error('Fail - {} - {}'.format(_file, e))
-                continue
-            except FileExistsError:
-                logging.error('Fail - {} - file already exists'.format(_file))
-                continue
-            [f.write(str(random.randint(0, 9))) for _ in range(_size)]
-            f.close()
-            logging.info('OK - {}'.format(_file))
+            name = '{}-{}B'.format(n, _size)
+            _file = os.path.join(self.path, name)
+            digest = write_file(_file, _size, mode, seed=file_seed(seed, name),
+                                algorithm=algorithm if manifest else None)
+            if digest is not None:
+                entries.append({'path': name, 'size': _size, 'mode': mode,
+                                algorithm: digest})
+                logging.info('OK - {}'.format(_file))
+        if manifest:
+            save_manifest(manifest, entries, seed, algorithm)
         logging.info('File creation completed')
 
+    def generate_fileset(self, fileset, fanout=0, depth=0, mode='digits',
+                         workers=None, processes=False, fsync=False,
+                         seed=None, manifest=None, algorithm='sha256'):
+        """Create set of files spread over directory tree in a pool of
+        threads or processes. Files of every spec are distributed among leaf
+        directories in turn, all directories are created before files.
+        File names are prefixed with spec index, so specs of equal size do
+        not collide.
+
+        :param fileset: iterable of dicts with 'size', 'files' and optional
+                        'mode' keys (the same as generate() parameters)
+        :param fanout: number of subdirectories of every directory
+                       (default = 0, flat directory)
+        :param depth: number of directory levels (default = 0)
+        :param mode: content mode of specs without 'mode' key
+                     (default = 'digits')
+        :param workers: number of workers (default = pool default)
+        :param processes: use process pool instead of thread pool
+                          (default = False)
+        :param fsync: flush every file to disk (default = False)
+        :param seed: seed for reproducible content; every file gets its own
+                     stream, so content does not depend on number of workers
+                     (default = None, not reproducible)
+        :param manifest: path of manifest to write; digests are computed
+                         while files are written (default = None)
+        :param algorithm: hashlib algorithm of manifest digests
+                          (default = 'sha256')
+
+        :return: dict with number of created files, their total size in
+                 bytes, elapsed time in seconds, files/sec and MB/sec
+
+        :raise ValueError:
+                   - file size < 0
+                   - number of files < 1
+                   - unknown content mode
+                   - fanout or depth < 0
+        """
+        if fanout < 0 or depth < 0:
+            logging.error('Fanout and depth should be >= 0, not {} and {}'
+                          ''.format(fanout, depth))
+            raise ValueError('Fanout and depth should be >= 0, not {} and {}'
+                             ''.format(fanout, depth))
+        tasks = []
+        leaves = tree(self.path, fanout, depth)
+        for s, spec in enumerate(fileset):
+            _size = int(spec['size'])
+            _files = int(spec['files'])
+            _mode = spec.get('mode', mode)
+            if _size < 0:
+                logging.error(
+                    'File size should be >= 0, not {}'.format(_size))
+                raise ValueError(
+                    'File size should be >= 0, not {}'.format(_size))
+            if _files <= 0:
+                logging.error(
+                    'Files number should be > 0, not {}'.format(_files))
+                raise ValueError(
+                    'Files number should be > 0, not {}'.format(_files))
+            if _mode not in MODES:
+                logging.error('Unknown content mode: {}'.format(_mode))
+                raise ValueError('Unknown content mode: {}'.format(_mode))
+            for n in range(_files):
+                _file = os.path.join(leaves[n % len(leaves)],
+                                     '{}-{}-{}B'.format(s, n, _size))
+                name = os.path.relpath(_file, self.path).replace(os.sep, '/')
+                tasks.append((_file, name, _size, _mode,
+                              file_seed(seed, name)))
+        logging.info('Got fileset: {} file(s) in {} directory(ies)'
+                     ''.format(len(tasks), len(leaves)))
+        start = time.perf_counter()
+        for leaf in leaves:
+            os.makedirs(leaf, exist_ok=True)
+        executor = futures.ProcessPoolExecutor if processes \
+            else futures.ThreadPoolExecutor
+        entries = []
+        with executor(max_workers=workers) as pool:
+            results = [pool.submit(_write_batch, tasks[n:n + BATCH_FILES],
+                                   fsync, algorithm if manifest else None)
+                       for n in range(0, len(tasks), BATCH_FILES)]
+            for result in futures.as_completed(results):
+                entries.extend(result.result())
+        elapsed = time.perf_counter() - start
+        if manifest:
+            save_manifest(manifest, entries, seed, algorithm)
+        files = len(entries)
+        written = sum(e['size'] for e in entries)
+        report = {
+            'files': files,
+            'bytes': written,
+            'seconds': elapsed,
+            'files_per_sec': files / elapsed if elapsed else 0.0,
+            'mb_per_sec': written / 2**20 / elapsed if elapsed else 0.0,
+        }
+        logging.info('Fileset created: {files} file(s), {bytes} byte(s) in '
+                     '{seconds:.2f} s ({files_per_sec:.0f} files/s, '
+                     '{mb_per_sec:.1f} MB/s)'.format(**report))
+        return report
+
+    def regenerate(self, manifest, files=None):
+        """Create files listed in manifest again from its seed, e.g. to
+        restore deleted files or make a copy of file set elsewhere.
+        Existing files are not overwritten, their digests are verified.
+
+        :param manifest: manifest path
+        :param files: paths (relative, as in manifest) of files to create
+                      (default = None, all files)
+
+        :return: list of paths (as in manifest) of files which were not
+                 created or whose digest differs from manifest
+
+        :raise ValueError if manifest has no seed
+        """
+        data = load_manifest(manifest)
+        if data['seed'] is None:
+            logging.error('Manifest has no seed: {}'.format(manifest))
+            raise ValueError('Manifest has no seed: {}'.format(manifest))
+        algorithm = data['algorithm']
+        failed = []
+        for entry in data['files']:
+            if files is not None and entry['path'] not in files:
+                continue
+            _file = os.path.join(self.path, *entry['path'].split('/'))
+            if os.path.exists(_file):
+                try:
+                    digest = file_digest(_file, algorithm)
+                except IOError as e:
+                    logging.error('Fail - {} - {}'.format(_file, e))
+                    digest = None
+            else:
+                os.makedirs(os.path.dirname(_file), exist_ok=True)
+                digest = write_file(
+                    _file, entry['size'], entry['mode'],
+                    seed=file_seed(data['seed'], entry['path']),
+                    algorithm=algorithm, block_size=data['block_size'])
+            if digest is None:
+                failed.append(entry['path'])
+            elif digest != entry.get(algorithm):
+                logging.error('Fail - {} - digest mismatch'.format(_file))
+                failed.append(entry['path'])
+            else:
+                logging.info('OK - {}'.format(_file))
+        return failed
+
 
 if __name__ == '__main__':
     FILESET = (
@@ -91,8 +489,11 @@ if __name__ == '__main__':
         # {'size': 2**20,    'files': 1},
         # {'size': 2**20*5,  'files': 1},
         # {'size': 1024,     'files': 300},
+        # {'size': 2**30,    'files': 1, 'mode': 'random'},
     )
     PATH = ''
+    FANOUT = 0  # e.g. 16 subdirectories per directory
+    DEPTH = 0   # e.g. 3 levels, 16**3 leaf directories
 
     filegen = FileGenerator(PATH)
-    [filegen.generate(**params) for params in FILESET]
+    print(filegen.generate_fileset(FILESET, fanout=FANOUT, depth=DEPTH))
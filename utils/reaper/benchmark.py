@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks for reaper engines"""
+
+import os
+import io
+import sys
+import gzip
+import json
+import lzma
+import time
+import shutil
+import random
+import socket
+import argparse
+import platform
+import datetime
+import tempfile
+
+from . import settings
+from . import filters
+from . import gentestlog
+from . import merge
+from . import render
+from . import timeparse
+from . import reaper
+from .sftpstub import LocalSFTPServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def legacy_timestamp(line):
+    """Timestamp extraction as it was done before TimestampParser
+
+    :param line: log line
+
+    :return: POSIX timestamp or None
+    """
+    for p in settings.compiled_time_patterns:
+        r = p.search(line)
+        if r:
+            return datetime.datetime(
+                int(r.group('year')), int(r.group('month')),
+                int(r.group('day')), int(r.group('hour')),
+                int(r.group('min')), int(r.group('sec')),
+                int(r.group('ms')) * 1000
+            ).timestamp()
+    return None
+
+
+def sample_lines(number, time_format='%d-%m-%Y %H:%M:%S.%f', seed=0):
+    """Generate log lines with ascending timestamps
+
+    :param number: number of lines
+    :param time_format: timestamp format
+    :param seed: random seed
+
+    :return: list of lines
+    """
+    rnd = random.Random(seed)
+    t = datetime.datetime(2020, 1, 1)
+    lines = []
+    for n in range(number):
+        t += datetime.timedelta(microseconds=rnd.randrange(10**6))
+        lines.append('{} -- message #{} from worker {}\n'.format(
+            t.strftime(time_format), n, rnd.randrange(100)))
+    return lines
+
+
+def measure(function, lines):
+    """Apply function to every line and measure throughput
+
+    :param function: function to call with line
+    :param lines: list of lines
+
+    :return: tuple with list of results and lines per second
+    """
+    start = time.perf_counter()
+    results = [function(line) for line in lines]
+    return results, len(lines) / (time.perf_counter() - start)
+
+
+def bench_timestamps(number=200000):
+    """Compare TimestampParser with legacy per-pattern loop
+
+    :param number: number of lines per time format
+    """
+    print('Timestamp extraction, {} lines'.format(number))
+    for time_format in ('%d-%m-%Y %H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S.%f'):
+        lines = sample_lines(number, time_format)
+        legacy, legacy_speed = measure(legacy_timestamp, lines)
+        parser = timeparse.TimestampParser()
+        parsed, speed = measure(parser.parse, lines)
+        assert parsed == legacy, 'Results differ from legacy extraction'
+        print('    {:<24} legacy {:>10.0f} lines/s, parser {:>10.0f} lines/s '
+              '(x{:.1f})'.format(time_format, legacy_speed, speed,
+                                 speed / legacy_speed))
+
+
+def bench_filter(number=1000000):
+    """Compare LineFilter scanning memory-mapped file with line by line
+    substring check of decoded text
+
+    :param number: number of lines in test file
+    """
+    print('Line filter, {} lines'.format(number))
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            f.writelines(sample_lines(number))
+        size = os.path.getsize(path) / 2**20
+        for terms in (['worker 42'], ['worker 42', 'worker 17', '#99999']):
+            start = time.perf_counter()
+            with open(path, 'rt') as source:
+                legacy = [line for line in source
+                          if any(t in line for t in terms)]
+            legacy_speed = size / (time.perf_counter() - start)
+            line_filter = filters.LineFilter(terms)
+            destination = io.BytesIO()
+            start = time.perf_counter()
+            line_filter.filter_file(path, destination)
+            speed = size / (time.perf_counter() - start)
+            assert destination.getvalue().decode() == ''.join(legacy), \
+                'Results differ from legacy filter'
+            print('    {} term(s): legacy {:>8.1f} MB/s, filter {:>8.1f} MB/s '
+                  '(x{:.1f})'.format(len(terms), legacy_speed, speed,
+                                     speed / legacy_speed))
+    finally:
+        os.remove(path)
+
+
+def bench_decompress(number=1000000):
+    """Compare filtering of plain log with filtering of its gzip and xz
+    copies decompressed on the fly
+
+    :param number: number of lines in test file
+    """
+    print('Compressed logs, {} lines'.format(number))
+    data = ''.join(sample_lines(number)).encode()
+    line_filter = filters.LineFilter(['worker 42'])
+    expected = io.BytesIO()
+    line_filter.filter_stream(io.BytesIO(data), expected, final=True)
+    for name, compress in (('plain.log', bytes),
+                           ('gzip.log.gz', gzip.compress),
+                           ('xz.log.xz', lzma.compress)):
+        packed = compress(data)
+        destination = io.BytesIO()
+        start = time.perf_counter()
+        line_filter.filter_stream(
+            filters.decompressed(io.BytesIO(packed), name), destination,
+            final=True)
+        elapsed = time.perf_counter() - start
+        assert destination.getvalue() == expected.getvalue(), \
+            'Results differ from plain log'
+        print('    {:<12} {:>8.1f} MB stored, {:>6.2f} s, {:>8.1f} MB/s of '
+              'log'.format(name, len(packed) / 2**20, elapsed,
+                           len(data) / 2**20 / elapsed))
+
+
+class CountingSocket(socket.socket):
+    """Socket counting bytes sent and received"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+        self.received = 0
+
+    def send(self, data, *args):
+        n = super().send(data, *args)
+        self.sent += n
+        return n
+
+    def recv(self, size, *args):
+        data = super().recv(size, *args)
+        self.received += len(data)
+        return data
+
+
+def bench_harvest(host=settings.HOST, port=settings.PORT):
+    """Download remote logs with and without SSH compression
+
+    :param host: host name
+    :param port: SFTP port
+    """
+    print('Harvest from {}:{}'.format(host, port))
+    for compress in (False, True):
+        dest_dir = tempfile.mkdtemp()
+        sock = CountingSocket()
+        sock.connect((host, port))
+        transport = reaper.Transport()
+        try:
+            start = time.perf_counter()
+            transport.connect(host, port, compress=compress, sock=sock)
+            files = list(transport.download(dest_dir=dest_dir))
+            elapsed = time.perf_counter() - start
+        finally:
+            transport.disconnect()
+            shutil.rmtree(dest_dir, ignore_errors=True)
+        print('    compression {:<3} {} file(s), {:>6.2f} s, {:>8.1f} MB '
+              'received'.format('on' if compress else 'off', len(files),
+                                elapsed, sock.received / 2**20))
+
+
+PIPELINE_SIZES = (2**24, 2**26)  # Corpus sizes, bytes
+PIPELINE_FILES = (1, 8)  # Numbers of log files in corpus
+PIPELINE_TERM = 'lorem'  # Selection pattern (about 10% of test lines)
+
+
+def _reset_peak_rss():
+    """Reset peak resident set size of current process (Linux only)
+
+    :return: True if peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Get peak resident set size of current process
+
+    :return: peak RSS, MB, or None if it is unknown
+    """
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _stage(results, corpus, name, size, lines, function, *args):
+    """Run pipeline stage and record its metrics
+
+    :param results: list to append stage metrics to
+    :param corpus: corpus description (dict)
+    :param name: stage name
+    :param size: number of bytes processed by stage
+    :param lines: number of lines processed by stage
+    :param function: stage function
+    :param args: function arguments
+
+    :return: function result
+    """
+    _reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    metrics = dict(corpus, stage=name, seconds=elapsed, bytes=size,
+                   lines=lines, mb_per_s=size / 2**20 / elapsed,
+                   lines_per_s=lines / elapsed, peak_rss_mb=_peak_rss())
+    results.append(metrics)
+    print('    {:<9} {:>8.2f} s {:>9.1f} MB/s {:>11.0f} lines/s {:>8} MB '
+          'RSS'.format(name, elapsed, metrics['mb_per_s'],
+                       metrics['lines_per_s'],
+                       '?' if metrics['peak_rss_mb'] is None else
+                       '{:.0f}'.format(metrics['peak_rss_mb'])))
+    return result
+
+
+def _line_count(paths):
+    """Count lines in files"""
+    lines = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                lines += chunk.count(b'\n')
+    return lines
+
+
+def bench_pipeline(sizes=PIPELINE_SIZES, file_counts=PIPELINE_FILES,
+                   workers=settings.PARALLEL_WORKERS):
+    """Run reaper pipeline on generated corpora served by local SFTP stub.
+    Stages are download, refine, parse (timestamp extraction of refined
+    lines), sort (merge of parsed logs) and render (HTML output).
+
+    :param sizes: corpus sizes, bytes
+    :param file_counts: numbers of log files in corpus
+    :param workers: number of worker processes for refinement
+
+    :return: list of stage metrics (dicts)
+    """
+    results = []
+    line_filter = filters.LineFilter([PIPELINE_TERM])
+    for size in sizes:
+        for files in file_counts:
+            corpus = {'corpus_bytes': size, 'files': files}
+            print('Pipeline, {:.0f} MB in {} file(s)'.format(size / 2**20,
+                                                             files))
+            work_dir = tempfile.mkdtemp(prefix='reaper-bench-')
+            try:
+                remote_dir, raw_dir, processed_dir = [
+                    os.path.join(work_dir, d)
+                    for d in ('remote', 'raw', 'processed')]
+                for d in (remote_dir, raw_dir, processed_dir):
+                    os.mkdir(d)
+                generated = gentestlog.generate_corpus(
+                    remote_dir, ['log{:03d}'.format(n) for n in range(files)],
+                    size=size // files, jitter=1.0, disorder=0.01)
+                raw_bytes = sum(g[2] for g in generated)
+                raw_lines = sum(g[1] for g in generated)
+                with LocalSFTPServer(remote_dir) as server:
+                    transport = reaper.Transport()
+                    transport.connect(server.host, server.port, 'bench',
+                                      'bench')
+                    try:
+                        _stage(results, corpus, 'download', raw_bytes,
+                               raw_lines, lambda: list(transport.download(
+                                   '', raw_dir, r'.*\.log$')))
+                    finally:
+                        transport.disconnect()
+                _stage(results, corpus, 'refine', raw_bytes, raw_lines,
+                       lambda: list(reaper.refine(
+                           line_filter, raw_dir, processed_dir,
+                           workers=workers)))
+                logs = reaper.processed_logs([reaper.Host(
+                    processed_dir=processed_dir)])
+                refined_bytes = sum(os.path.getsize(log[0]) for log in logs)
+                refined_lines = _line_count([log[0] for log in logs])
+                parsed = _stage(results, corpus, 'parse', refined_bytes,
+                                refined_lines, lambda: [
+                                    list(reaper.read_records(*log))
+                                    for log in logs])
+                merged = _stage(results, corpus, 'sort', refined_bytes,
+                                refined_lines,
+                                lambda: list(merge.merge(parsed)))
+                del parsed
+                _stage(results, corpus, 'render', refined_bytes,
+                       refined_lines, render.HtmlRenderer(
+                           os.path.join(work_dir, 'reconstructed.htm')
+                       ).render, merged)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def save_results(results, path):
+    """Save pipeline metrics with environment description to JSON file
+
+    :param results: list of stage metrics
+    :param path: result file path
+    """
+    with open(path, 'wt') as f:
+        json.dump({'date': datetime.datetime.now().isoformat(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'cpus': os.cpu_count(),
+                   'results': results}, f, indent=2)
+    print('Results saved to {}'.format(path))
+
+
+def compare_results(results, path):
+    """Print throughput of stages relative to previous run
+
+    :param results: list of stage metrics
+    :param path: result file of previous run
+    """
+    with open(path, 'rt') as f:
+        previous = {(r['corpus_bytes'], r['files'], r['stage']): r
+                    for r in json.load(f)['results']}
+    print('Compared with {}'.format(path))
+    for r in results:
+        p = previous.get((r['corpus_bytes'], r['files'], r['stage']))
+        if p is None or not p['mb_per_s']:
+            continue
+        print('    {:>6.0f} MB {:>4} file(s) {:<9} x{:.2f} MB/s, x{:.2f} '
+              'time'.format(r['corpus_bytes'] / 2**20, r['files'],
+                            r['stage'], r['mb_per_s'] / p['mb_per_s'],
+                            r['seconds'] / p['seconds']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reaper benchmarks')
+    parser.add_argument('--harvest', action='store_true',
+                        help='also download logs from settings.HOST with '
+                             'and without SSH compression')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run end-to-end pipeline benchmark instead of '
+                             'micro-benchmarks')
+    parser.add_argument('--sizes', nargs='+', type=gentestlog.parse_size,
+                        default=PIPELINE_SIZES,
+                        help='corpus sizes for pipeline benchmark, e.g. 16M '
+                             '1G')
+    parser.add_argument('--files', nargs='+', type=int,
+                        default=PIPELINE_FILES,
+                        help='numbers of log files for pipeline benchmark')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=settings.PARALLEL_WORKERS,
+                        help='number of worker processes for refinement')
+    parser.add_argument('-o', '--output',
+                        help='JSON file to save pipeline results to')
+    parser.add_argument('-c', '--compare',
+                        help='JSON file with results of previous pipeline '
+                             'run to compare with')
+    args = parser.parse_args()
+    if args.pipeline:
+        results = bench_pipeline(args.sizes, args.files, args.jobs)
+        if args.output:
+            save_results(results, args.output)
+        if args.compare:
+            compare_results(results, args.compare)
+        sys.exit(0)
+    bench_timestamps()
+    bench_filter()
+    bench_decompress()
+    if args.harvest:
+        bench_harvest()
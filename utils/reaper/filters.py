@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Line filtering engine for reaper"""
+
+import os
+import re
+import gzip
+import lzma
+import mmap
+import json
+import threading
+import collections
+
+from . import settings
+
+
+# Extensions of compressed logs
+COMPRESSED = ('.gz', '.xz')
+
+
+def is_compressed(name):
+    """Check if log is compressed (by file name extension)
+
+    :param name: file name
+
+    :return: True for compressed log
+    """
+    return os.path.splitext(name)[1] in COMPRESSED
+
+
+def decompressed(fileobj, name):
+    """Wrap binary file object to read decompressed data if needed
+
+    :param fileobj: binary file object
+    :param name: file name
+
+    :return: file object with decompressed data (or fileobj itself for
+             uncompressed log)
+    """
+    extension = os.path.splitext(name)[1]
+    if extension == '.gz':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if extension == '.xz':
+        return lzma.LZMAFile(fileobj, 'rb')
+    return fileobj
+
+
+def count_lines(buffer, start=0, end=None, chunk_size=2**24):
+    """Count line breaks in a range of buffer
+
+    :param buffer: bytes-like object (bytes, mmap)
+    :param start: range start (default = 0)
+    :param end: range end (default = end of buffer)
+    :param chunk_size: size of a piece copied at once for buffers without
+                       count() method, bytes
+
+    :return: number of line breaks
+    """
+    end = len(buffer) if end is None else end
+    if isinstance(buffer, bytes):
+        return buffer.count(b'\n', start, end)
+    lines = 0
+    for pos in range(start, end, chunk_size):
+        lines += buffer[pos:min(pos + chunk_size, end)].count(b'\n')
+    return lines
+
+
+class LineFilter:
+    """Multi-term line filter.
+
+    Line is selected if it contains any of include terms and none of
+    exclude terms. Terms are plain substrings or regular expressions.
+    Data is scanned as bytes without decoding lines: substrings are searched
+    with bytes.find, keeping the next occurrence of every term, regular
+    expressions are combined in one alternation. Per-line work is done only
+    around found occurrences.
+
+    :ivar counts: number of selected lines per include term
+    :ivar excluded: number of lines rejected by exclude terms
+    """
+
+    def __init__(self, include, exclude=(), regex=False):
+        """
+        :param include: list of include terms
+        :param exclude: list of exclude terms
+        :param regex: treat terms as regular expressions (default = False)
+
+        :raise ValueError if no include terms are given or any term
+                          contains line break
+        """
+        if not include:
+            raise ValueError('At least one include term is required')
+        if any('\n' in t for t in list(include) + list(exclude)):
+            raise ValueError('Terms can not contain line breaks')
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.regex = regex
+        self.counts = collections.OrderedDict((t, 0) for t in self.include)
+        self.excluded = 0
+        self._lock = threading.Lock()
+        if regex:
+            self._include = [self._compile([t]) for t in self.include]
+            self._combined = self._compile(self.include)
+        else:
+            self._include = [t.encode() for t in self.include]
+            self._combined = None
+        self._exclude = self._compile(self.exclude) if self.exclude else None
+
+    def _compile(self, terms):
+        """Compile terms to one bytes regex with alternation
+
+        :param terms: list of terms
+
+        :return: compiled regex
+        """
+        return re.compile(b'|'.join(
+            b'(?:' + (t.encode() if self.regex else re.escape(t.encode())) +
+            b')' for t in terms), re.MULTILINE)
+
+    @property
+    def rules(self):
+        """Arguments to create the same filter (e.g. in another process)"""
+        return self.include, self.exclude, self.regex
+
+    def add_counts(self, counts, excluded):
+        """Add numbers of selected and excluded lines
+
+        :param counts: list with number of selected lines per include term
+        :param excluded: number of excluded lines
+        """
+        with self._lock:
+            for term, count in zip(self.include, counts):
+                self.counts[term] += count
+            self.excluded += excluded
+
+    @property
+    def signature(self):
+        """Text representation of filter rules (to detect rule changes)"""
+        return json.dumps({'include': self.include, 'exclude': self.exclude,
+                           'regex': self.regex}, sort_keys=True)
+
+    def _finder(self, buffer, start, end):
+        """Get function to find next include term occurrence
+
+        :param buffer: bytes-like object
+        :param start: position to scan from
+        :param end: position to scan to
+
+        :return: function, which takes position and returns position of
+                 next occurrence (or -1)
+        """
+        if self._combined is not None:
+            def find(pos):
+                m = self._combined.search(buffer, pos, end)
+                return m.start() if m else -1
+            return find
+        terms = self._include
+        if len(terms) == 1:
+            return lambda pos: buffer.find(terms[0], pos, end)
+        nexts = [buffer.find(t, start, end) for t in terms]
+
+        def find(pos):
+            for n, p in enumerate(nexts):
+                if -1 < p < pos:
+                    nexts[n] = buffer.find(terms[n], pos, end)
+            found = [p for p in nexts if p != -1]
+            return min(found) if found else -1
+        return find
+
+    def lines(self, buffer, start=0, end=None):
+        """Find selected lines in a buffer of complete lines
+
+        :param buffer: bytes-like object (bytes, mmap)
+        :param start: position of line start to scan from (default = 0)
+        :param end: position to scan to; buffer[start:end] should end with
+                    newline, otherwise last line is completed with it
+                    (default = end of buffer)
+
+        :return: selected lines (with trailing newline)
+        """
+        end = len(buffer) if end is None else end
+        counts = [0] * len(self.include)
+        excluded = 0
+        find = self._finder(buffer, start, end)
+        try:
+            pos = find(start)
+            while pos != -1:
+                line_start = buffer.rfind(b'\n', start, pos) + 1 or start
+                line_end = buffer.find(b'\n', pos, end) + 1 or end
+                line = buffer[line_start:line_end]
+                pos = find(line_end) if line_end < end else -1
+                if self._combined is None:
+                    hits = [n for n, t in enumerate(self._include)
+                            if t in line]
+                else:
+                    hits = [n for n, t in enumerate(self._include)
+                            if t.search(line)]
+                    if not hits:
+                        # Regex match spans line boundary
+                        continue
+                if self._exclude is not None and self._exclude.search(line):
+                    excluded += 1
+                    continue
+                for n in hits:
+                    counts[n] += 1
+                yield line if line.endswith(b'\n') else line + b'\n'
+        finally:
+            self.add_counts(counts, excluded)
+
+    def filter_stream(self, source, destination,
+                      chunk_size=settings.DOWNLOAD_CHUNK, final=False):
+        """Copy selected lines from source to destination.
+        Source is read chunk by chunk, so memory usage does not depend on its
+        size. Trailing incomplete line (without newline) is left unread,
+        unless source is final.
+
+        :param source: binary file object to read from
+        :param destination: binary file object to write selected lines to
+        :param chunk_size: size of a single read, bytes
+        :param final: source will not grow, so trailing incomplete line
+                      is filtered too (default = False)
+
+        :return: tuple with number of consumed bytes, number of selected
+                 lines and number of scanned lines
+        """
+        consumed = 0
+        matched = 0
+        scanned = 0
+        tail = b''
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                if not final or not tail:
+                    break
+                chunk = b'\n'
+            buffer = tail + chunk
+            end = buffer.rfind(b'\n') + 1
+            tail = buffer[end:]
+            if not end:
+                continue
+            consumed += end
+            scanned += count_lines(buffer, 0, end)
+            for line in self.lines(buffer, 0, end):
+                destination.write(line)
+                matched += 1
+        return consumed, matched, scanned
+
+    def filter_file(self, path, destination, offset=0, final=False):
+        """Copy selected lines from local file to destination.
+        File is memory-mapped and scanned in place. Trailing incomplete line
+        (without newline) is left unread, unless file is final.
+
+        :param path: file path
+        :param destination: binary file object to write selected lines to
+        :param offset: position of line start to scan from (default = 0)
+        :param final: file will not grow, so trailing incomplete line is
+                      filtered too (default = False)
+
+        :return: tuple with number of consumed bytes, number of selected
+                 lines and number of scanned lines
+        """
+        matched = 0
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            if size <= offset:
+                return 0, 0, 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = size if final else mm.rfind(b'\n', offset) + 1
+                if not end:
+                    return 0, 0, 0
+                for line in self.lines(mm, offset, end):
+                    destination.write(line)
+                    matched += 1
+                scanned = count_lines(mm, offset, end) + \
+                    (mm[end - 1:end] != b'\n')
+        return end - offset, matched, scanned
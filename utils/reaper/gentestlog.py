@@ -1,38 +1,246 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-"""Script generates test data for reaper"""
+"""Script generates test data for reaper.
 
-import radar
-import forgery_py
-from datetime import date
+Logs are generated in batches: timestamps of a batch are laid out in
+ascending order (one per equal time slot) and may be displaced to make
+logs slightly out of order, message text is picked from vocabulary table.
+Output depends on seed only, not on number of worker processes.
+"""
+
+import os
+import re
+import sys
+import random
+import argparse
+import datetime
+from concurrent import futures
 
 
 DATE_FORMAT = '%d-%m-%Y'
 DATETIME_FORMAT = DATE_FORMAT + ' %H:%M:%S.%f'
-DATETIME_PARSE = [(DATETIME_FORMAT, True)]
 
 LOG_FILES = ['A', 'B', 'C', 'D', 'E']
 NUMBER_OF_LINES = 15
 
+VOCABULARY = tuple("""
+lorem ipsum dolor sit amet consectetuer adipiscing elit aenean commodo
+ligula eget massa cum sociis natoque penatibus et magnis dis parturient
+montes nascetur ridiculus mus donec quam felis ultricies nec pellentesque
+eu pretium quis sem nulla consequat enim pede justo fringilla vel aliquet
+vulputate arcu in rhoncus ut imperdiet a venenatis vitae dictum mollis
+integer tincidunt cras dapibus vivamus elementum semper nisi eleifend
+tellus leo porttitor ac aliquam ante viverra feugiat phasellus metus
+varius laoreet
+""".split())
+WORDS_PER_LINE = (4, 12)
+BATCH_LINES = 10000  # Number of lines formatted and written at once
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+
+def parse_size(text):
+    """Convert size with optional unit (K, M, G) to bytes
+
+    :param text: size, e.g. '512', '64K' or '2G'
+
+    :return: number of bytes
+
+    :raise ValueError if size is malformed
+    """
+    m = re.fullmatch(r'(\d+)([KMG]?)B?', text.strip().upper())
+    if m is None:
+        raise ValueError('Malformed size: {}'.format(text))
+    return int(m.group(1)) * SIZE_UNITS[m.group(2)]
+
+
+def messages(rnd, number, vocabulary=VOCABULARY):
+    """Make a batch of messages from vocabulary
+
+    :param rnd: random generator (random.Random instance)
+    :param number: number of messages
+    :param vocabulary: sequence of words
+
+    :return: list of messages
+    """
+    lengths = [rnd.randint(*WORDS_PER_LINE) for _ in range(number)]
+    words = rnd.choices(vocabulary, k=sum(lengths))
+    batch = []
+    pos = 0
+    for length in lengths:
+        text = ' '.join(words[pos:pos + length])
+        batch.append(text[0].upper() + text[1:] + '.')
+        pos += length
+    return batch
+
+
+def timestamps(rnd, first, number, start, step, jitter=0.0, disorder=0.0):
+    """Make a batch of ascending timestamps.
+    Every timestamp is put at random point of its own time slot, so batch
+    is sorted without sorting. Fraction of timestamps is displaced by up to
+    jitter seconds.
+
+    :param rnd: random generator (random.Random instance)
+    :param first: number of the first slot
+    :param number: number of timestamps
+    :param start: POSIX timestamp of the first slot start
+    :param step: slot length, seconds
+    :param jitter: maximum displacement, seconds
+    :param disorder: fraction of displaced timestamps (0..1)
+
+    :return: list of POSIX timestamps
+    """
+    random_ = rnd.random
+    batch = [start + (n + random_()) * step
+             for n in range(first, first + number)]
+    if jitter and disorder:
+        for n in range(number):
+            if random_() < disorder:
+                batch[n] += rnd.uniform(-jitter, jitter)
+    return batch
+
+
+class TimeFormatter:
+    """Format POSIX timestamps as DATETIME_FORMAT with one strftime call
+    per minute"""
+
+    def __init__(self):
+        self._minute = None
+        self._prefix = ''
+
+    def __call__(self, timestamp):
+        minute, seconds = divmod(timestamp, 60)
+        if minute != self._minute:
+            self._minute = minute
+            self._prefix = datetime.datetime.fromtimestamp(
+                minute * 60).strftime(DATE_FORMAT + ' %H:%M:')
+        microseconds = int(seconds * 10**6)
+        return '{}{:02d}.{:06d}'.format(self._prefix, microseconds // 10**6,
+                                        microseconds % 10**6)
+
+
+def generate_file(path, lines=None, size=None, day=None, jitter=0.0,
+                  disorder=0.0, seed=0):
+    """Generate one log file covering one day.
+    Size target is met at line boundary, so file may be slightly larger.
+
+    :param path: file path
+    :param lines: number of lines
+    :param size: file size, bytes (used if number of lines is not given)
+    :param day: date of log records (default = today)
+    :param jitter: maximum displacement of timestamp, seconds
+    :param disorder: fraction of displaced timestamps (0..1)
+    :param seed: random seed (None = not reproducible)
+
+    :return: tuple with number of written lines and bytes
+
+    :raise ValueError if neither lines nor size is given
+    """
+    if lines is None and size is None:
+        raise ValueError('Number of lines or file size is required')
+    rnd = random.Random(None if seed is None else '{}:{}'.format(
+        seed, os.path.basename(path)))
+    day = day or datetime.date.today()
+    start = datetime.datetime.combine(day, datetime.time()).timestamp()
+    end = datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time()).timestamp()
+    if lines is None:
+        # Estimate number of lines from a sample to spread them over the day
+        sample = messages(random.Random(seed), 1000)
+        line_size = len('{} -- \n'.format(TimeFormatter()(start))) + \
+            sum(map(len, sample)) / len(sample)
+        expected = max(1, int(size / line_size))
+    else:
+        expected = lines
+    step = (end - start) / expected
+    format_time = TimeFormatter()
+    written_lines = 0
+    written_bytes = 0
+    with open(path, 'wb') as f:
+        while True:
+            if lines is not None:
+                number = min(BATCH_LINES, lines - written_lines)
+            else:
+                number = BATCH_LINES if written_bytes < size else 0
+            if number <= 0:
+                break
+            chunk = ''.join(['{} -- {}\n'.format(format_time(t), message)
+                             for t, message in zip(
+                                 timestamps(rnd, written_lines, number,
+                                            start, step, jitter, disorder),
+                                 messages(rnd, number))]).encode()
+            if lines is None and written_bytes + len(chunk) > size:
+                cut = chunk.find(b'\n', size - written_bytes - 1) + 1
+                number = chunk.count(b'\n', 0, cut)
+                chunk = chunk[:cut]
+            f.write(chunk)
+            written_lines += number
+            written_bytes += len(chunk)
+    return written_lines, written_bytes
+
+
+def generate_corpus(directory='.', files=LOG_FILES, lines=None, size=None,
+                    day=None, jitter=0.0, disorder=0.0, seed=0, workers=1):
+    """Generate set of log files, optionally in several processes
+
+    :param directory: output directory
+    :param files: log names (without extension)
+    :param lines: number of lines per file
+    :param size: size of every file, bytes
+    :param day: date of log records (default = today)
+    :param jitter: maximum displacement of timestamp, seconds
+    :param disorder: fraction of displaced timestamps (0..1)
+    :param seed: random seed
+    :param workers: number of worker processes (1 = serial)
 
-def test_parse(timestamp):
-    return radar.utils.parse(timestamp, formats=DATETIME_PARSE)
+    :return: list of tuples with file path, number of lines and bytes
+    """
+    paths = [os.path.join(directory, f + '.log') for f in files]
+    args = (lines, size, day or datetime.date.today(), jitter, disorder,
+            seed)
+    if workers > 1:
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = [pool.submit(generate_file, path, *args)
+                       for path in paths]
+            results = [r.result() for r in results]
+    else:
+        results = [generate_file(path, *args) for path in paths]
+    return [(path,) + r for path, r in zip(paths, results)]
 
 
 def generate_test_logs():
-    current_date = date.today().strftime(DATE_FORMAT)
-    test_files = [f+'.log' for f in LOG_FILES]
-    for test_file in test_files:
-        f = open(test_file, 'wt')
-        for _ in range(NUMBER_OF_LINES):
-            r = radar.random_datetime(start=current_date+' 00:00:00.000000',
-                                      stop=current_date+' 23:59:59.999999',
-                                      parse=test_parse)
-            f.write('{} -- {}\n'.format(r.strftime('%d-%m-%Y %H:%M:%S.%f'),
-                                        forgery_py.lorem_ipsum.sentence()))
-        f.close()
+    generate_corpus(lines=NUMBER_OF_LINES, seed=None)
 
 
 if __name__ == '__main__':
-    generate_test_logs()
+    if len(sys.argv) == 1:
+        generate_test_logs()
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='Generate test logs')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-n', '--lines', type=int,
+                        help='number of lines per file')
+    target.add_argument('-s', '--size', type=parse_size,
+                        help='size of every file, e.g. 64M or 2G')
+    parser.add_argument('-d', '--dir', default='.',
+                        help='output directory (default: %(default)s)')
+    parser.add_argument('-f', '--files', nargs='+', default=LOG_FILES,
+                        help='log names (default: %(default)s)')
+    parser.add_argument('--date',
+                        type=lambda d: datetime.datetime.strptime(
+                            d, '%Y-%m-%d').date(),
+                        help='date of records, YYYY-MM-DD (default: today)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='maximum displacement of timestamp, seconds')
+    parser.add_argument('--disorder', type=float, default=0.0,
+                        help='fraction of displaced timestamps (0..1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes')
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+    for path, lines, size in generate_corpus(
+            args.dir, args.files, args.lines, args.size, args.date,
+            args.jitter, args.disorder, args.seed, args.jobs):
+        print('{:.<30}...{} lines, {} bytes'.format(path, lines, size))
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Persisted harvest manifest for incremental runs"""
+
+import os
+import json
+import logging
+
+from . import settings
+
+
+class Manifest:
+    """Record of harvested files, kept between reaper runs.
+
+    Every entry describes one log file: remote size and modification time
+    seen on last download, number of raw bytes already refined and size of
+    refined log written from them.
+    """
+
+    def __init__(self, path=settings.MANIFEST):
+        """Load manifest from file if it exists
+
+        :param path: manifest file path
+        """
+        self.path = path
+        self.pattern = None
+        self.files = dict()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'rt') as f:
+                    data = json.load(f)
+                self.pattern = data.get('pattern')
+                self.files = data.get('files', dict())
+                logging.info('Manifest loaded: {} ({} files)'.format(
+                    self.path, len(self.files)))
+            except (ValueError, OSError) as e:
+                logging.warning('Manifest is damaged and will be rebuilt: '
+                                '{} - {}'.format(self.path, e))
+
+    def get(self, name):
+        """Get manifest entry
+
+        :param name: file name
+
+        :return: dict with 'size', 'mtime', 'refined' (and 'processed')
+                 keys or None
+        """
+        return self.files.get(name)
+
+    def update(self, name, **fields):
+        """Update manifest entry, create it if needed
+
+        :param name: file name
+        :param fields: entry fields to set
+        """
+        entry = self.files.setdefault(
+            name, {'size': 0, 'mtime': 0, 'refined': 0})
+        entry.update(fields)
+
+    def reset_refined(self, pattern):
+        """Forget refine progress if selection pattern has changed
+
+        :param pattern: selection rules (filter signature) of current run
+
+        :return: True if refine progress has been reset
+        """
+        if self.pattern == pattern:
+            return False
+        logging.info('Selection pattern changed: {} -> {}'.format(
+            self.pattern, pattern))
+        reset = any(entry['refined'] for entry in self.files.values())
+        for entry in self.files.values():
+            entry['refined'] = 0
+        self.pattern = pattern
+        return reset
+
+    def save(self):
+        """Write manifest to file
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump({'pattern': self.pattern, 'files': self.files}, f,
+                      indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        logging.info('Manifest saved: {}'.format(self.path))
+
+
+def open_processed(path, offset, entry=None):
+    """Open refined log to write lines refined from given offset.
+    Lines appended after refine progress was last saved (by a run which
+    failed or was killed before saving manifest) are cut off, so they are
+    not written twice.
+
+    :param path: refined log path
+    :param offset: number of raw bytes already refined (0 = start anew)
+    :param entry: manifest entry of the log or None
+
+    :return: tuple with binary file object and its size before writing
+    """
+    if not offset:
+        return open(path, 'wb'), 0
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    processed = entry.get('processed') if entry else None
+    f = open(path, 'ab')
+    if processed is not None and processed < size:
+        logging.warning('Cut off {} byte(s) not recorded in manifest: '
+                        '{}'.format(size - processed, path))
+        f.truncate(processed)
+        size = processed
+    return f, size
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Streaming merge engine for timeline reconstruction"""
+
+import time
+import heapq
+import logging
+import operator
+
+from . import settings
+
+
+def reorder(items, window=settings.REORDER_WINDOW,
+            key=operator.itemgetter(0)):
+    """Sort almost ordered stream of items.
+    Items are kept in a heap of limited size, so any item displaced by less
+    than window positions is put in place. Items with equal keys keep their
+    original order.
+
+    :param items: iterable with items
+    :param window: number of items held for reordering
+    :param key: function to get sort key from item
+                (default = first element of item)
+
+    :return: items in ascending order of key
+    """
+    heap = []
+    last = None
+    misplaced = 0
+    for n, item in enumerate(items):
+        heapq.heappush(heap, (key(item), n, item))
+        if len(heap) > window:
+            k, _, _item = heapq.heappop(heap)
+            if last is not None and k < last:
+                misplaced += 1
+            last = k
+            yield _item
+    while heap:
+        k, _, _item = heapq.heappop(heap)
+        if last is not None and k < last:
+            misplaced += 1
+        last = k
+        yield _item
+    if misplaced:
+        logging.warning('{} item(s) are out of order more than reorder '
+                        'window ({}) allows'.format(misplaced, window))
+
+
+def merge(streams, window=settings.REORDER_WINDOW,
+          key=operator.itemgetter(0)):
+    """Merge several almost ordered streams into one ordered stream.
+    Memory usage is proportional to number of streams and window size,
+    not to total number of items.
+
+    :param streams: list of iterables with items
+    :param window: number of items held for reordering in every stream
+    :param key: function to get sort key from item
+                (default = first element of item)
+
+    :return: items in ascending order of key
+    """
+    return heapq.merge(*[reorder(s, window, key) for s in streams], key=key)
+
+
+class LagReorder:
+    """Reorder buffer for live streams.
+    Every item is held for lag seconds after arrival, so items arriving
+    slightly later than items with greater keys are still put in place.
+    """
+
+    def __init__(self, lag=settings.FOLLOW_LAG, key=operator.itemgetter(0)):
+        """
+        :param lag: holding time of an item, seconds
+        :param key: function to get sort key from item
+                    (default = first element of item)
+        """
+        self.lag = lag
+        self._key = key
+        self._heap = []
+        self._count = 0
+        self._last = None
+        self.late = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, now=None):
+        """Add item to buffer
+
+        :param item: item
+        :param now: arrival time, time.monotonic() value (default = now)
+        """
+        if now is None:
+            now = time.monotonic()
+        heapq.heappush(self._heap, (self._key(item), self._count, now, item))
+        self._count += 1
+
+    def _pop(self):
+        """Remove item with the least key and count it if it is late"""
+        k, _, _, item = heapq.heappop(self._heap)
+        if self._last is not None and k < self._last:
+            self.late += 1
+        else:
+            self._last = k
+        return item
+
+    def pop(self, now=None):
+        """Release items held long enough
+
+        :param now: current time, time.monotonic() value (default = now)
+
+        :return: items in ascending order of key
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._heap and self._heap[0][2] <= now - self.lag:
+            yield self._pop()
+
+    def flush(self):
+        """Release all items
+
+        :return: items in ascending order of key
+        """
+        while self._heap:
+            yield self._pop()
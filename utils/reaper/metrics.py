@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Run metrics of reaper stages.
+
+Stages record numbers to the module registry (``registry``): connect
+latency, transferred bytes and transfer time, scanned and matched lines,
+parse failures, merge and render time. Registry is exported as JSON summary
+or Prometheus textfile, and every recorded value is passed to hooks, so a
+program using reaper as a library can watch a run:
+
+    def hook(name, value, labels):
+        print(name, labels, value)
+
+    metrics.registry.add_hook(hook)
+"""
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+import contextlib
+import collections
+
+from . import settings
+
+
+PREFIX = 'reaper_'
+DESCRIPTIONS = {
+    'connect_seconds': 'Time to establish SFTP session',
+    'transfer_bytes': 'Bytes read from remote log',
+    'transfer_seconds': 'Time of reading remote log',
+    'scanned_lines': 'Lines scanned by filter',
+    'matched_lines': 'Lines selected by filter',
+    'parsed_lines': 'Refined lines with timestamp',
+    'parse_failures': 'Refined lines without valid timestamp',
+    'merge_seconds': 'Time of parsing and merging refined logs',
+    'render_seconds': 'Time of writing timeline',
+    'rendered_rows': 'Rows of reconstructed timeline',
+    'stage_seconds': 'Wall time of stage',
+}
+
+
+class Metrics:
+    """Thread-safe registry of run metrics.
+    Values are kept per metric name and set of labels.
+    """
+
+    def __init__(self):
+        self._values = collections.OrderedDict()
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Register function called on every recorded value
+
+        :param hook: function called as hook(name, value, labels) with
+                     metric name, recorded value (increment for add()) and
+                     dict of labels
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Unregister hook function
+
+        :param hook: function registered with add_hook()
+        """
+        self._hooks.remove(hook)
+
+    def _record(self, name, value, labels, increment):
+        """Store value and notify hooks"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if increment:
+                self._values[key] = self._values.get(key, 0) + value
+            else:
+                self._values[key] = value
+        for hook in list(self._hooks):
+            try:
+                hook(name, value, dict(labels))
+            except Exception as e:
+                logging.error('Metrics hook {} failed: {}'.format(hook, e))
+
+    def add(self, name, value, **labels):
+        """Add value to metric
+
+        :param name: metric name
+        :param value: number to add
+        :param labels: metric labels
+        """
+        self._record(name, value, labels, True)
+
+    def set(self, name, value, **labels):
+        """Set metric value
+
+        :param name: metric name
+        :param value: metric value
+        :param labels: metric labels
+        """
+        self._record(name, value, labels, False)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Measure execution time of with-block and add it to metric
+
+        :param name: metric name
+        :param labels: metric labels
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, **labels)
+
+    def timed(self, items, name, **labels):
+        """Measure time spent to produce items of iterable (lazy stage)
+
+        :param items: iterable
+        :param name: metric name
+        :param labels: metric labels
+
+        :return: the same items
+        """
+        items = iter(items)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.add(name, elapsed, **labels)
+
+    def get(self, name, **labels):
+        """Get metric value
+
+        :param name: metric name
+        :param labels: metric labels
+
+        :return: metric value or None if it was not recorded
+        """
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        """Forget all values (hooks are kept)
+        """
+        with self._lock:
+            self._values.clear()
+
+    def summary(self):
+        """Get all values
+
+        :return: list of dicts with metric name, labels and value
+        """
+        with self._lock:
+            return [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in self._values.items()]
+
+    def save_json(self, path=settings.METRICS_FILE):
+        """Write JSON summary
+
+        :param path: output file path
+        """
+        _write(path, json.dumps({
+            'date': datetime.datetime.now().isoformat(),
+            'metrics': self.summary()}, indent=2))
+
+    def save_prometheus(self, path=settings.PROMETHEUS_FILE):
+        """Write Prometheus textfile (for node exporter textfile collector)
+
+        :param path: output file path (*.prom)
+        """
+        metrics = collections.OrderedDict()
+        for m in self.summary():
+            metrics.setdefault(m['name'], []).append(m)
+        lines = []
+        for name, values in metrics.items():
+            lines.append('# HELP {}{} {}'.format(
+                PREFIX, name, DESCRIPTIONS.get(name, name)))
+            lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+            for m in values:
+                labels = ','.join('{}="{}"'.format(
+                    k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                    .replace('\n', '\\n'))
+                    for k, v in sorted(m['labels'].items()))
+                lines.append('{}{}{} {}'.format(
+                    PREFIX, name, '{' + labels + '}' if labels else '',
+                    m['value']))
+        _write(path, '\n'.join(lines) + '\n')
+
+    def export(self, json_path=settings.METRICS_FILE,
+               prometheus_path=settings.PROMETHEUS_FILE):
+        """Write JSON summary and Prometheus textfile
+
+        :param json_path: JSON summary path (None to skip)
+        :param prometheus_path: Prometheus textfile path (None to skip)
+        """
+        if json_path:
+            self.save_json(json_path)
+        if prometheus_path:
+            self.save_prometheus(prometheus_path)
+
+
+def _write(path, text):
+    """Replace file content atomically, so readers never see partial file"""
+    with open(path + '.tmp', 'wt') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+    logging.info('Metrics saved: {}'.format(path))
+
+
+registry = Metrics()
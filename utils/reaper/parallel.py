@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Process pool execution of reaper refine and parse stages"""
+
+import os
+import lzma
+import mmap
+import array
+import heapq
+import shutil
+import logging
+import operator
+import tempfile
+from concurrent import futures
+
+from . import settings
+from . import filters
+from . import merge
+from . import metrics
+from . import timeparse
+from .manifest import open_processed
+
+
+def split(path, offset=0, chunk_size=settings.PARALLEL_CHUNK, final=False):
+    """Split file into byte ranges on line boundaries.
+    Trailing incomplete line (without newline) is not included, unless file
+    is final.
+
+    :param path: file path
+    :param offset: position of line start to split from (default = 0)
+    :param chunk_size: approximate size of a range, bytes
+    :param final: file will not grow, so trailing incomplete line is
+                  included in last range (default = False)
+
+    :return: list of tuples with range start and end
+    """
+    ranges = []
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        if size <= offset:
+            return ranges
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            last = size if final else mm.rfind(b'\n', offset) + 1
+            start = offset
+            while start < last:
+                end = mm.find(b'\n', min(start + chunk_size, last) - 1,
+                              last) + 1 or last
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def _refine_range(rules, raw_path, part_path, start, end):
+    """Filter byte range of raw log (runs in worker process)
+
+    :param rules: line filter rules (LineFilter.rules)
+    :param raw_path: raw log path
+    :param part_path: path of file to write selected lines to
+    :param start: range start
+    :param end: range end
+
+    :return: tuple with number of selected lines, list with number of
+             selected lines per include term, number of excluded lines and
+             number of scanned lines
+    """
+    line_filter = filters.LineFilter(*rules)
+    matched = 0
+    with open(raw_path, 'rb') as f, open(part_path, 'wb') as destination, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in line_filter.lines(mm, start, end):
+            destination.write(line)
+            matched += 1
+        scanned = filters.count_lines(mm, start, end) + \
+            (mm[end - 1:end] != b'\n')
+    return (matched, list(line_filter.counts.values()), line_filter.excluded,
+            scanned)
+
+
+def _refine_compressed(rules, raw_path, part_path):
+    """Filter whole compressed log (runs in worker process)
+
+    :param rules: line filter rules (LineFilter.rules)
+    :param raw_path: compressed log path
+    :param part_path: path of file to write selected lines to
+
+    :return: tuple with number of selected lines, list with number of
+             selected lines per include term, number of excluded lines and
+             number of scanned lines
+    """
+    line_filter = filters.LineFilter(*rules)
+    with open(raw_path, 'rb') as f, open(part_path, 'wb') as destination:
+        _, matched, scanned = line_filter.filter_stream(
+            filters.decompressed(f, raw_path), destination, final=True)
+    return (matched, list(line_filter.counts.values()), line_filter.excluded,
+            scanned)
+
+
+def refine(line_filter, raw_dir=settings.RAW_DIR,
+           processed_dir=settings.PROCESSED_DIR, manifest=None,
+           workers=settings.PARALLEL_WORKERS,
+           chunk_size=settings.PARALLEL_CHUNK):
+    """Filter raw logs in a process pool.
+    Every raw log is split into byte ranges on line boundaries, ranges are
+    filtered by worker processes and their results are joined in order, so
+    refined logs are the same as after serial refinement. Compressed logs
+    cannot be split and are filtered by one worker each.
+
+    :param line_filter: line filter (filters.LineFilter instance)
+    :param raw_dir: directory with raw logs
+    :param processed_dir: directory for refined logs
+    :param manifest: harvest manifest (Manifest instance) or None
+    :param workers: number of worker processes
+    :param chunk_size: approximate size of a byte range, bytes
+
+    :return: list with filename, number of new matching lines and number
+             of scanned lines
+    """
+    parts_dir = tempfile.mkdtemp(
+        prefix='parts-', dir=os.path.dirname(os.path.normpath(processed_dir)))
+    try:
+        with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = []
+            for raw_log in os.listdir(raw_dir):
+                raw_path = os.path.join(raw_dir, raw_log)
+                if not os.path.isfile(raw_path):
+                    continue
+                entry = manifest.get(raw_log) if manifest is not None \
+                    else None
+                offset = entry['refined'] if entry else 0
+                tasks = []
+                if filters.is_compressed(raw_log):
+                    size = os.path.getsize(raw_path)
+                    if offset != size:
+                        part_path = os.path.join(parts_dir, raw_log)
+                        tasks.append((part_path, pool.submit(
+                            _refine_compressed, line_filter.rules, raw_path,
+                            part_path)))
+                    jobs.append((raw_log, offset and not tasks, size, tasks))
+                    continue
+                ranges = split(raw_path, offset, chunk_size,
+                               final=manifest is None)
+                for n, (start, end) in enumerate(ranges):
+                    part_path = os.path.join(
+                        parts_dir, '{}.{}'.format(raw_log, n))
+                    tasks.append((part_path, pool.submit(
+                        _refine_range, line_filter.rules, raw_path,
+                        part_path, start, end)))
+                jobs.append((raw_log, offset,
+                             ranges[-1][1] if ranges else offset, tasks))
+            logging.info('Refining {} range(s) of {} file(s) with {} '
+                         'worker(s)'.format(sum(len(j[3]) for j in jobs),
+                                            len(jobs), workers))
+            for raw_log, append, offset, tasks in jobs:
+                processed_path = os.path.join(processed_dir, raw_log)
+                matched = 0
+                scanned = 0
+                destination, _ = open_processed(
+                    processed_path, append,
+                    manifest.get(raw_log) if manifest is not None else None)
+                with destination:
+                    for part_path, task in tasks:
+                        try:
+                            part_matched, counts, excluded, part_scanned = \
+                                task.result()
+                        except (IOError, EOFError, lzma.LZMAError) as e:
+                            if not filters.is_compressed(raw_log):
+                                raise
+                            # Keep refine progress as serial refine does
+                            logging.error('Failed to decompress {}: {}'
+                                          ''.format(raw_log, e))
+                            entry = manifest.get(raw_log) \
+                                if manifest is not None else None
+                            offset = entry['refined'] if entry else 0
+                        else:
+                            line_filter.add_counts(counts, excluded)
+                            matched += part_matched
+                            scanned += part_scanned
+                        with open(part_path, 'rb') as part:
+                            shutil.copyfileobj(part, destination)
+                        os.remove(part_path)
+                if manifest is not None:
+                    manifest.update(raw_log, refined=offset,
+                                    processed=os.path.getsize(processed_path))
+                logging.info('Refined {} - {} new lines'.format(
+                    raw_log, matched))
+                yield [raw_log, matched, scanned]
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def _parse_file(path, window):
+    """Make sorted run of timestamped lines of refined log (runs in worker
+    process)
+
+    :param path: refined log path
+    :param window: number of lines held for reordering
+
+    :return: tuple with arrays of timestamps and line offsets and number of
+             lines without valid timestamp
+    """
+    timestamps = array.array('d')
+    offsets = array.array('Q')
+    parser = timeparse.TimestampParser()
+    for timestamp, offset, _ in merge.reorder(timeparse.scan(path, parser),
+                                              window):
+        timestamps.append(timestamp)
+        offsets.append(offset)
+    return timestamps, offsets, parser.failures
+
+
+def _run(timestamps, offsets, file_id, skew):
+    """Turn arrays returned by worker into stream of records
+
+    :return: tuple with timestamp, file id and line offset
+    """
+    for timestamp, offset in zip(timestamps, offsets):
+        yield timestamp - skew, file_id, offset
+
+
+def records(logs, window=settings.REORDER_WINDOW,
+            workers=settings.PARALLEL_WORKERS):
+    """Parse refined logs in a process pool and merge results.
+    Workers return compact sorted runs of (timestamp, offset); main process
+    merges runs and reads only lines being output. Order is the same as
+    after serial reconstruction.
+
+    :param logs: list of tuples with refined log path, log name and clock
+                 skew to subtract from timestamps
+    :param window: number of lines per log held for reordering
+    :param workers: number of worker processes
+
+    :return: tuple with timestamp, log name and line
+    """
+    with futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        tasks = [pool.submit(_parse_file, path, window)
+                 for path, _, _ in logs]
+        runs = []
+        for file_id, task in enumerate(tasks):
+            timestamps, offsets, failures = task.result()
+            metrics.registry.add('parsed_lines', len(timestamps),
+                                 file=logs[file_id][1])
+            metrics.registry.add('parse_failures', failures,
+                                 file=logs[file_id][1])
+            runs.append(_run(timestamps, offsets, file_id, logs[file_id][2]))
+    logging.info('Parsed {} file(s) with {} worker(s)'.format(
+        len(logs), workers))
+    sources = [open(path, 'rb') for path, _, _ in logs]
+    try:
+        for timestamp, file_id, offset in heapq.merge(
+                *runs, key=operator.itemgetter(0)):
+            source = sources[file_id]
+            source.seek(offset)
+            yield (timestamp, logs[file_id][1],
+                   timeparse.decode(source.readline()))
+    finally:
+        for source in sources:
+            source.close()
@@ -2,16 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import argparse
 import os
 import stat
 import shutil
 import re
-import datetime
+import lzma
+import time
+import queue
 import logging
+from concurrent import futures
 import paramiko
 from paramiko import ssh_exception
 
 from . import settings
+from . import filters
+from . import merge
+from . import metrics
+from . import parallel
+from . import render
+from . import timeline
+from . import timeparse
+from .manifest import Manifest, open_processed
 
 
 def rm_readonly(fun, path, _):
@@ -29,27 +41,40 @@ class TransportError(Exception):
 class Transport:
     """Class for establishing SFTP session and file download"""
 
-    def __init__(self):
+    def __init__(self, name=None):
+        """
+        :param name: host name to label metrics with (default = None, host
+                     address is used)
+        """
         self._client = paramiko.SSHClient()
         self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._transport = None
         self._sftp = None
+        self.host = None
+        self.name = name
 
     def connect(self, host=settings.HOST, port=settings.PORT,
-                user=settings.USER, password=settings.PASSWORD):
+                user=settings.USER, password=settings.PASSWORD,
+                compress=settings.SSH_COMPRESSION, sock=None):
         """Connect to server
 
         :param host: host name
         :param port: SFTP port
         :param user: username
         :param password: password
+        :param compress: turn on SSH transport compression
+        :param sock: connected socket-like object to use instead of opening
+                     a new one (default = None)
 
         :raise TransportError on client exception
         """
         logging.info('Connecting to {}@{}:{}'.format(user, host, port))
+        self.host = host
+        start = time.perf_counter()
         try:
             self._client.connect(hostname=host, port=port,
-                                 username=user, password=password)
+                                 username=user, password=password,
+                                 compress=compress, sock=sock)
             logging.info('Connected successfully')
         except ssh_exception.BadHostKeyException as e:
             logging.error(
@@ -76,6 +101,9 @@ class Transport:
         try:
             self._sftp = paramiko.SFTPClient.from_transport(self._transport)
             logging.info('SFTP session established')
+            metrics.registry.set('connect_seconds',
+                                 time.perf_counter() - start,
+                                 host=self.name or host)
         except paramiko.SSHException as e:
             logging.error(
                 '{}@{}:{} - SFTP session failure: {}'
@@ -97,158 +125,844 @@ class Transport:
         except AttributeError:
             pass
 
+    def _open_sftp(self):
+        """Open one more SFTP channel over established SSH transport
+
+        :return: SFTP client or None if server refused to open channel
+        """
+        try:
+            return paramiko.SFTPClient.from_transport(self._transport)
+        except paramiko.SSHException as e:
+            logging.warning('Unable to open additional SFTP channel: '
+                            '{}'.format(e))
+            return None
+
+    @staticmethod
+    def _fetch(sftp, remote_path, local_path, offset=0):
+        """Download single file with prefetched (pipelined) reads
+
+        :param sftp: SFTP client
+        :param remote_path: remote file path
+        :param local_path: local file path
+        :param offset: download only bytes starting from this position and
+                       append them to local file (default = 0)
+
+        :raise IOError on file access error
+        """
+        with sftp.open(remote_path, 'rb') as source, \
+                open(local_path, 'r+b' if offset else 'wb') as destination:
+            source.seek(offset)
+            destination.seek(offset)
+            destination.truncate()
+            source.prefetch(source.stat().st_size)
+            shutil.copyfileobj(source, destination, settings.DOWNLOAD_CHUNK)
+
+    @staticmethod
+    def _resume_offset(attr, entry, local_path):
+        """Find out which part of remote file should be downloaded
+
+        :param attr: remote file attributes
+        :param entry: manifest entry of the file (or None)
+        :param local_path: local file path
+
+        :return: offset to download from or None if file is unchanged
+        """
+        if entry is None or not os.path.isfile(local_path) or \
+                os.path.getsize(local_path) != entry['size']:
+            return 0
+        if attr.st_size == entry['size'] and attr.st_mtime == entry['mtime']:
+            return None
+        if attr.st_size > entry['size'] and \
+                not filters.is_compressed(attr.filename):
+            return entry['size']
+        return 0
+
+    @staticmethod
+    def _stream_offset(attr, entry):
+        """Find out which part of remote file should be streamed
+
+        :param attr: remote file attributes
+        :param entry: manifest entry of the file (or None)
+
+        :return: offset to stream from or None if file is unchanged
+        """
+        if entry is None:
+            return 0
+        if entry['refined'] and attr.st_size == entry['size'] and \
+                attr.st_mtime == entry['mtime']:
+            return None
+        if attr.st_size >= entry['refined'] and \
+                not filters.is_compressed(attr.filename):
+            return entry['refined']
+        return 0
+
+    def _list(self, source_dir, mask):
+        """List remote log files
+
+        :param source_dir: remote directory path
+        :param mask: file mask
+
+        :return: tuple with normalized remote directory path and list of
+                 attributes of files matching mask
+        """
+        remote_dir = self._sftp.normalize(source_dir)
+        attrs = self._sftp.listdir_attr(remote_dir)
+        logging.info('All files: {}'.format([a.filename for a in attrs]))
+        log_files = [a for a in attrs if re.match(mask, a.filename)]
+        logging.info('Log files: {}'.format([a.filename for a in log_files]))
+        return remote_dir, log_files
+
+    def _run(self, jobs, task, workers):
+        """Run jobs concurrently through a pool of SFTP channels
+
+        :param jobs: list of job arguments
+        :param task: function called as task(sftp, *job)
+        :param workers: number of concurrent SFTP channels
+
+        :return: tuple with job and task result, as jobs are finished
+        """
+        channels = queue.Queue()
+        channels.put(self._sftp)
+        extra_channels = []
+        for _ in range(min(int(workers), len(jobs)) - 1):
+            sftp = self._open_sftp()
+            if sftp is None:
+                break
+            extra_channels.append(sftp)
+            channels.put(sftp)
+        logging.info('SFTP channels: {}'.format(len(extra_channels) + 1))
+
+        def run(job):
+            sftp = channels.get()
+            try:
+                return task(sftp, *job)
+            finally:
+                channels.put(sftp)
+
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=len(extra_channels) + 1) as pool:
+                tasks = {pool.submit(run, job): job for job in jobs}
+                for t in futures.as_completed(tasks):
+                    yield tasks[t], t.result()
+        finally:
+            for sftp in extra_channels:
+                sftp.close()
+
     def download(self, source_dir=settings.REMOTE_DIR,
-                 dest_dir=settings.RAW_DIR, mask=settings.LOGFILE_MASK):
-        """Download files specified by mask
+                 dest_dir=settings.RAW_DIR, mask=settings.LOGFILE_MASK,
+                 workers=settings.DOWNLOAD_WORKERS, manifest=None):
+        """Download files specified by mask.
+        Files are fetched concurrently through a pool of SFTP channels opened
+        over one SSH transport; results are yielded as files are finished.
+        If manifest is given, unchanged files are skipped and only appended
+        bytes of grown files are downloaded.
 
         :param source_dir: remote directory path
         :param dest_dir: local directory path
         :param mask: file mask
+        :param workers: number of concurrent SFTP channels
+        :param manifest: harvest manifest (Manifest instance) or None
 
         :return: list with filename and download result
+                 ('OK', 'Fail' or 'Unchanged')
         """
         logging.info('Download files')
         logging.info('Source: {}'.format(source_dir))
         logging.info('Destination: {}'.format(dest_dir))
         logging.info('Mask: {}'.format(mask))
-        remote_dir = self._sftp.normalize(source_dir)
-        files = self._sftp.listdir(remote_dir)
-        logging.info('All files: {}'.format(files))
-        log_files = filter(lambda f: re.match(mask, f), files)
-        logging.info('Log files: {}'.format(log_files))
-        for l in log_files:
-            result = [l]
+        remote_dir, log_files = self._list(source_dir, mask)
+        jobs = []
+        for attr in log_files:
+            name = attr.filename
+            offset = 0
+            if manifest is not None:
+                offset = self._resume_offset(attr, manifest.get(name),
+                                             os.path.join(dest_dir, name))
+                if offset is None:
+                    logging.info('Unchanged - {}'.format(name))
+                    yield [name, 'Unchanged']
+                    continue
+            jobs.append((attr, offset))
+
+        def fetch(sftp, attr, offset):
+            name = attr.filename
+            local_path = os.path.join(dest_dir, name)
             try:
-                self._sftp.get(os.path.join(remote_dir, l),
-                               os.path.join(dest_dir, l))
-                result.append('OK')
-                logging.info('OK - {}'.format(l))
+                start = time.perf_counter()
+                self._fetch(sftp, os.path.join(remote_dir, name), local_path,
+                            offset)
+                metrics.registry.add('transfer_seconds',
+                                     time.perf_counter() - start,
+                                     host=self.name or self.host,
+                                     file=name)
+                metrics.registry.add('transfer_bytes',
+                                     os.path.getsize(local_path) - offset,
+                                     host=self.name or self.host,
+                                     file=name)
+                logging.info('OK - {} (from byte {})'.format(name, offset))
+                return [name, 'OK']
             except IOError:
-                result.append('Fail')
-                logging.error('Failed - {}'.format(l))
-            finally:
-                yield result
+                logging.error('Failed - {}'.format(name))
+                return [name, 'Fail']
+
+        for (attr, offset), result in self._run(jobs, fetch, workers):
+            if manifest is not None and result[1] == 'OK':
+                fields = {'size': os.path.getsize(
+                    os.path.join(dest_dir, attr.filename)),
+                    'mtime': attr.st_mtime}
+                if not offset:
+                    fields['refined'] = 0
+                manifest.update(attr.filename, **fields)
+            yield result
         logging.info('Download completed')
 
+    def stream(self, line_filter, source_dir=settings.REMOTE_DIR,
+               dest_dir=settings.PROCESSED_DIR, mask=settings.LOGFILE_MASK,
+               workers=settings.DOWNLOAD_WORKERS, manifest=None):
+        """Filter remote files specified by mask while they are being read.
+        Raw logs are never stored: only lines selected by filter are
+        written to destination directory. Compressed logs are decompressed
+        on the fly. Files are processed concurrently like in download().
+        If manifest is given, unchanged files are skipped and only appended
+        bytes of grown files are read.
+
+        :param line_filter: line filter (filters.LineFilter instance)
+        :param source_dir: remote directory path
+        :param dest_dir: local directory path for refined logs
+        :param mask: file mask
+        :param workers: number of concurrent SFTP channels
+        :param manifest: harvest manifest (Manifest instance) or None
+
+        :return: list with filename, result ('OK', 'Fail' or 'Unchanged')
+                 and number of new matching lines
+        """
+        logging.info('Stream files')
+        logging.info('Source: {}'.format(source_dir))
+        logging.info('Destination: {}'.format(dest_dir))
+        logging.info('Mask: {}'.format(mask))
+        logging.info('Filter: {}'.format(line_filter.signature))
+        remote_dir, log_files = self._list(source_dir, mask)
+        jobs = []
+        for attr in log_files:
+            name = attr.filename
+            offset = 0
+            if manifest is not None:
+                offset = self._stream_offset(attr, manifest.get(name))
+                if offset is None:
+                    logging.info('Unchanged - {}'.format(name))
+                    yield [name, 'Unchanged', 0]
+                    continue
+            jobs.append((attr, offset))
+
+        def refine_remote(sftp, attr, offset):
+            name = attr.filename
+            remote_path = os.path.join(remote_dir, name)
+            local_path = os.path.join(dest_dir, name)
+            destination, size = open_processed(
+                local_path, offset,
+                manifest.get(name) if manifest is not None else None)
+            try:
+                start = time.perf_counter()
+                with sftp.open(remote_path, 'rb') as source, destination:
+                    source.seek(offset)
+                    source.prefetch(source.stat().st_size)
+                    if filters.is_compressed(name):
+                        _, matched, scanned = line_filter.filter_stream(
+                            filters.decompressed(source, name), destination,
+                            final=True)
+                        refined = attr.st_size
+                    else:
+                        consumed, matched, scanned = line_filter.filter_stream(
+                            source, destination, final=manifest is None)
+                        refined = offset + consumed
+                for metric, value in (
+                        ('transfer_seconds', time.perf_counter() - start),
+                        ('transfer_bytes', refined - offset),
+                        ('scanned_lines', scanned),
+                        ('matched_lines', matched)):
+                    metrics.registry.add(metric, value,
+                                         host=self.name or self.host,
+                                         file=name)
+                logging.info('OK - {} (from byte {}, {} new lines)'.format(
+                    name, offset, matched))
+                return [name, 'OK', matched], refined
+            except (IOError, EOFError, lzma.LZMAError):
+                logging.error('Failed - {}'.format(name))
+                # Drop lines of partial read, they will be read again
+                destination.close()
+                with open(local_path, 'ab') as f:
+                    f.truncate(size)
+                return [name, 'Fail', 0], offset
+
+        for (attr, _), (result, refined) in self._run(
+                jobs, refine_remote, workers):
+            if manifest is not None and result[1] == 'OK':
+                manifest.update(attr.filename, size=attr.st_size,
+                                mtime=attr.st_mtime, refined=refined,
+                                processed=os.path.getsize(os.path.join(
+                                    dest_dir, attr.filename)))
+            yield result
+        logging.info('Streaming completed')
+
     def __del__(self):
         self.disconnect()
 
 
+class Host:
+    """Harvest source: remote log directory and local copies of its logs"""
+
+    def __init__(self, name=None, host=settings.HOST, port=settings.PORT,
+                 user=settings.USER, password=settings.PASSWORD,
+                 remote_dir=settings.REMOTE_DIR, mask=settings.LOGFILE_MASK,
+                 skew=0, raw_dir=settings.RAW_DIR,
+                 processed_dir=settings.PROCESSED_DIR,
+                 manifest_path=settings.MANIFEST):
+        """
+        :param name: host name in inventory, used to tag its logs in
+                     timeline (None = single host, logs are not tagged)
+        :param host: host address
+        :param port: SFTP port
+        :param user: username
+        :param password: password
+        :param remote_dir: remote directory path
+        :param mask: log file mask
+        :param skew: number of seconds host clock is ahead of reference
+                     clock, subtracted from timestamps of its logs
+        :param raw_dir: local directory for raw logs
+        :param processed_dir: local directory for refined logs
+        :param manifest_path: harvest manifest file path
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.remote_dir = remote_dir
+        self.mask = mask
+        self.skew = skew
+        self.raw_dir = raw_dir
+        self.processed_dir = processed_dir
+        self.manifest_path = manifest_path
+        self.manifest = None
+        self.transport = Transport(name or host)
+        self.connected = False
+
+    def __str__(self):
+        return '{}@{}:{}'.format(self.user, self.host, self.port)
+
+    def label(self, log_name):
+        """Get name of host log in timeline
+
+        :param log_name: log file name
+
+        :return: log name tagged by host name
+        """
+        if self.name is None:
+            return log_name
+        return '{}/{}'.format(self.name, log_name)
+
+    def connect(self):
+        """Connect to host
+
+        :raise TransportError on failure
+        """
+        self.transport.connect(self.host, self.port, self.user,
+                               self.password)
+        self.connected = True
+
+    def disconnect(self):
+        """Disconnect from host
+        """
+        self.transport.disconnect()
+        self.connected = False
+
+
+def inventory(hosts=settings.HOSTS):
+    """Make harvest sources from host inventory.
+    Every host gets its own raw and processed directories and manifest in
+    working directory. Empty inventory means single host from connection
+    settings with plain working directory layout.
+
+    :param hosts: list of dicts with 'name' and optional Host arguments:
+                  'host', 'port', 'user', 'password', 'remote_dir', 'mask'
+                  and 'skew'
+
+    :return: list of Host instances
+
+    :raise ValueError if host has no name or names are not unique
+    """
+    if not hosts:
+        return [Host()]
+    sources = []
+    for h in hosts:
+        h = dict(h)
+        name = h.pop('name', None)
+        if not name:
+            raise ValueError('Host name is not defined: {}'.format(h))
+        if name in [source.name for source in sources]:
+            raise ValueError('Host name is not unique: {}'.format(name))
+        sources.append(Host(
+            name, raw_dir=os.path.join(settings.RAW_DIR, name),
+            processed_dir=os.path.join(settings.PROCESSED_DIR, name),
+            manifest_path=os.path.join(
+                settings.WORKING_DIR, 'manifest-{}.json'.format(name)),
+            **h))
+    return sources
+
+
+def prepare_dirs(clean=not settings.INCREMENTAL, hosts=()):
+    """Prepare working directories
+
+    :param clean: remove existing working directory first
+    :param hosts: harvest sources (Host instances) to prepare directories for
+    """
+    access_bits = stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
+    if clean and os.path.exists(settings.WORKING_DIR):
+        shutil.rmtree(settings.WORKING_DIR, onerror=rm_readonly)
+        print('Removed {}'.format(settings.WORKING_DIR))
+    dirs = [settings.WORKING_DIR, settings.RAW_DIR, settings.PROCESSED_DIR]
+    for host in hosts:
+        dirs.extend(d for d in (host.raw_dir, host.processed_dir)
+                    if d not in dirs)
+    for d in dirs:
+        if os.path.isdir(d):
+            print('Found {}'.format(d))
+        else:
+            os.mkdir(d, access_bits)
+            print('Created {}'.format(d))
+
+
+def _refine(line_filter, raw_dir, processed_dir, manifest):
+    """Filter raw logs in current process (see refine())"""
+    for raw_log in os.listdir(raw_dir):
+        raw_path = os.path.join(raw_dir, raw_log)
+        if not os.path.isfile(raw_path):
+            continue
+        entry = manifest.get(raw_log) if manifest is not None else None
+        offset = entry['refined'] if entry else 0
+        processed_path = os.path.join(processed_dir, raw_log)
+        matched = 0
+        scanned = 0
+        if filters.is_compressed(raw_log):
+            # Compressed log is refined as a whole once
+            size = os.path.getsize(raw_path)
+            if offset != size:
+                try:
+                    with open(raw_path, 'rb') as source, \
+                            open(processed_path, 'wb') as destination:
+                        _, matched, scanned = line_filter.filter_stream(
+                            filters.decompressed(source, raw_log),
+                            destination, final=True)
+                    offset = size
+                except (IOError, EOFError, lzma.LZMAError) as e:
+                    logging.error('Failed to decompress {}: {}'.format(
+                        raw_log, e))
+        else:
+            destination, _ = open_processed(processed_path, offset, entry)
+            with destination:
+                consumed, matched, scanned = line_filter.filter_file(
+                    raw_path, destination, offset, final=manifest is None)
+            offset += consumed
+        if manifest is not None:
+            fields = {'refined': offset}
+            if os.path.isfile(processed_path):
+                fields['processed'] = os.path.getsize(processed_path)
+            manifest.update(raw_log, **fields)
+        logging.info('Refined {} - {} new lines'.format(raw_log, matched))
+        yield [raw_log, matched, scanned]
+
+
+def refine(line_filter, raw_dir=settings.RAW_DIR,
+           processed_dir=settings.PROCESSED_DIR, manifest=None,
+           workers=settings.PARALLEL_WORKERS, host=None):
+    """Filter raw logs: keep lines selected by filter.
+    Raw logs are memory-mapped and scanned in place, compressed logs are
+    decompressed as a stream.
+    If manifest is given, only raw bytes appended since previous run are
+    filtered and matching lines are appended to processed files.
+
+    :param line_filter: line filter (filters.LineFilter instance)
+    :param raw_dir: directory with raw logs
+    :param processed_dir: directory for refined logs
+    :param manifest: harvest manifest (Manifest instance) or None
+    :param workers: number of worker processes (1 = serial)
+    :param host: host name to label metrics with (default = None)
+
+    :return: list with filename, number of new matching lines and number
+             of scanned lines
+    """
+    if workers > 1:
+        results = parallel.refine(line_filter, raw_dir, processed_dir,
+                                  manifest, workers)
+    else:
+        results = _refine(line_filter, raw_dir, processed_dir, manifest)
+    labels = dict() if host is None else {'host': host}
+    for r in results:
+        metrics.registry.add('scanned_lines', r[2], file=r[0], **labels)
+        metrics.registry.add('matched_lines', r[1], file=r[0], **labels)
+        yield r
+
+
+def clean_up(processed_dir=settings.PROCESSED_DIR):
+    """Delete all empty files from processed directory
+
+    :param processed_dir: directory with refined logs
+
+    :return: list with filename and result
+    """
+    for file in os.listdir(processed_dir):
+        path = os.path.join(processed_dir, file)
+        if not os.path.isfile(path):
+            continue
+        if os.path.getsize(path) == 0:
+            os.remove(path)
+            yield [file, 'Deleted']
+        else:
+            yield [file, 'Skipped']
+
+
+def harvest(host, line_filter, incremental=settings.INCREMENTAL,
+            workers=settings.PARALLEL_WORKERS, keep_connected=False):
+    """Download and refine logs of one host.
+    Failure of the host is reported, not raised, so several hosts can be
+    harvested concurrently.
+
+    :param host: harvest source (Host instance)
+    :param line_filter: line filter (filters.LineFilter instance)
+    :param incremental: use harvest manifest
+    :param workers: number of worker processes for refinement
+    :param keep_connected: do not disconnect after download (for follow
+                           mode)
+
+    :return: tuple with number of new matching lines, flag of selection
+             pattern change and list of report lines
+    """
+    new_lines = 0
+    pattern_changed = False
+    report = ['Host {}'.format(host.name or host.host)]
+    if incremental:
+        host.manifest = Manifest(host.manifest_path)
+        if host.manifest.reset_refined(line_filter.signature):
+            pattern_changed = True
+            report.append('Selection pattern has changed, all logs will be '
+                          'refined')
+
+    # Download log files (and filter them on the fly in streaming mode)
+    try:
+        with metrics.registry.timer('stage_seconds', stage='download',
+                                    host=host.name or host.host):
+            host.connect()
+            report.append('Connected to {}'.format(host))
+            if settings.STREAMING:
+                report.append('Streaming log files to {}'.format(
+                    host.processed_dir))
+                for r in host.transport.stream(
+                        line_filter, host.remote_dir, host.processed_dir,
+                        host.mask, manifest=host.manifest):
+                    report.append('    {:.<30}...{} ({} new line(s))'.format(
+                        *r))
+                    new_lines += r[2]
+            else:
+                report.append('Downloading log files to {}'.format(
+                    host.raw_dir))
+                for r in host.transport.download(
+                        host.remote_dir, host.raw_dir, host.mask,
+                        manifest=host.manifest):
+                    report.append('    {:.<30}...{}'.format(*r))
+    except (TransportError, IOError, paramiko.SSHException) as err:
+        report.append('Failed to harvest {}: {}'.format(host, err))
+        keep_connected = False
+    finally:
+        if not keep_connected:
+            host.disconnect()
+
+    # Filter raw logs
+    try:
+        if not settings.STREAMING:
+            report.append('Refining harvest: {}'.format(host.raw_dir))
+            with metrics.registry.timer('stage_seconds', stage='refine',
+                                        host=host.name or host.host):
+                for r in refine(line_filter, host.raw_dir,
+                                host.processed_dir, host.manifest, workers,
+                                host.name or host.host):
+                    report.append('    {:.<30}...{} new line(s)'.format(*r))
+                    new_lines += r[1]
+    except IOError as err:
+        report.append('Failed to refine {}: {}'.format(host, err))
+    finally:
+        if host.manifest is not None:
+            host.manifest.save()
+    return new_lines, pattern_changed, report
+
+
+def processed_logs(hosts):
+    """List refined logs of all hosts
+
+    :param hosts: harvest sources (Host instances)
+
+    :return: list of tuples with refined log path, log name tagged by host
+             and host clock skew
+    """
+    logs = []
+    for host in hosts:
+        for processed_file in os.listdir(host.processed_dir):
+            path = os.path.normpath(os.path.join(host.processed_dir,
+                                                 processed_file))
+            if os.path.isfile(path):
+                logs.append((path, host.label(processed_file), host.skew))
+    return logs
+
+
+def read_records(path, name, skew=0):
+    """Read timestamped records from refined log
+
+    :param path: refined log path
+    :param name: log name to put in records
+    :param skew: number of seconds to subtract from timestamps
+
+    :return: tuple with timestamp, log name and line
+    """
+    parser = timeparse.TimestampParser()
+    parsed = 0
+    for timestamp, _, line in timeparse.scan(path, parser):
+        parsed += 1
+        yield timestamp - skew, name, line
+    metrics.registry.add('parsed_lines', parsed, file=name)
+    metrics.registry.add('parse_failures', parser.failures, file=name)
+
+
+def reconstruct(rfilepath, logs, window=settings.REORDER_WINDOW,
+                workers=settings.PARALLEL_WORKERS,
+                timeline_dir=settings.TIMELINE_DIR):
+    """Combine refined logs in HTML sorted by timestamp.
+    Logs are merged as streams, rows are written while merge is running.
+    Large timelines are split into pages (see render.HtmlRenderer).
+    Merged timeline is also saved to time-indexed store for range queries
+    (see timeline.Timeline).
+
+    :param rfilepath: output file path
+    :param logs: list of tuples with refined log path, log name and clock
+                 skew (see processed_logs())
+    :param window: number of lines per log held for reordering
+    :param workers: number of worker processes for parsing (1 = serial)
+    :param timeline_dir: timeline store directory (None to skip saving)
+
+    :return: number of written rows
+    """
+    if workers > 1:
+        items = parallel.records(logs, window, workers)
+    else:
+        items = merge.merge([read_records(*log) for log in logs], window)
+    merge_time = metrics.registry.get('merge_seconds') or 0
+    items = metrics.registry.timed(items, 'merge_seconds')
+    if timeline_dir is not None:
+        items = timeline.TimelineWriter(timeline_dir).tee(items)
+    start = time.perf_counter()
+    rows = render.HtmlRenderer(rfilepath).render(items)
+    merge_time = metrics.registry.get('merge_seconds') - merge_time
+    metrics.registry.add('render_seconds',
+                         time.perf_counter() - start - merge_time)
+    metrics.registry.add('rendered_rows', rows)
+    return rows
+
+
+def _poll(host, line_filter, workers):
+    """Fetch and refine new data of remote logs (one follow mode poll)
+
+    :return: list of names of refined logs with new matching lines
+    """
+    if settings.STREAMING:
+        return [r[0] for r in host.transport.stream(
+            line_filter, host.remote_dir, host.processed_dir, host.mask,
+            manifest=host.manifest) if r[2]]
+    if not [r for r in host.transport.download(
+            host.remote_dir, host.raw_dir, host.mask, manifest=host.manifest)
+            if r[1] == 'OK']:
+        return []
+    return [r[0] for r in refine(line_filter, host.raw_dir,
+                                 host.processed_dir, host.manifest,
+                                 workers, host.name or host.host) if r[1]]
+
+
+def follow(hosts, line_filter, output=settings.FOLLOW_FILE,
+           interval=settings.FOLLOW_INTERVAL, lag=settings.FOLLOW_LAG,
+           workers=settings.PARALLEL_WORKERS):
+    """Poll remote logs for new data until interrupted (Ctrl+C).
+    Sessions stay open, only appended bytes are fetched and refined as in
+    incremental run. Hosts are polled concurrently; failed host is dropped
+    while others are still followed. New lines of refined logs are held
+    for lag seconds to be put in time order, then printed and appended to
+    output file.
+
+    :param hosts: connected harvest sources (Host instances with manifest)
+    :param line_filter: line filter (filters.LineFilter instance)
+    :param output: merged output file path
+    :param interval: polling interval, seconds
+    :param lag: holding time of new lines, seconds
+    :param workers: number of worker processes for refinement
+
+    :return: number of lines appended to output file
+    """
+    sizes = {(host, name): os.path.getsize(
+        os.path.join(host.processed_dir, name))
+        for host in hosts for name in os.listdir(host.processed_dir)}
+    parsers = dict()
+    buffer = merge.LagReorder(lag)
+    rows = 0
+    hosts = list(hosts)
+
+    def read(host, name):
+        path = os.path.join(host.processed_dir, name)
+        offset = sizes.get((host, name), 0)
+        if os.path.getsize(path) < offset:
+            # Log was truncated or rotated and refined anew
+            offset = 0
+        parser = parsers.setdefault((host, name), timeparse.TimestampParser())
+        with open(path, 'rb') as source:
+            source.seek(offset)
+            for raw in source:
+                line = timeparse.decode(raw)
+                timestamp = parser.parse(line)
+                if timestamp is not None:
+                    buffer.push((timestamp - host.skew, host.label(name),
+                                 line))
+            sizes[(host, name)] = source.tell()
+
+    with open(output, 'at', encoding='utf-8') as f, \
+            futures.ThreadPoolExecutor(max_workers=len(hosts)) as pool:
+
+        def write(records):
+            nonlocal rows
+            for timestamp, name, line in records:
+                row = '{} {:<20} {}'.format(render.format_time(timestamp),
+                                            name, line)
+                print(row)
+                f.write(row + '\n')
+                rows += 1
+            f.flush()
+
+        try:
+            while hosts:
+                started = time.monotonic()
+                tasks = {pool.submit(_poll, host, line_filter, workers): host
+                         for host in hosts}
+                for task in futures.as_completed(tasks):
+                    host = tasks[task]
+                    try:
+                        names = task.result()
+                    except (IOError, paramiko.SSHException) as e:
+                        logging.error('Following of {} stopped on transport '
+                                      'failure: {}'.format(host, e))
+                        print('Transport failure, {} is not followed any '
+                              'more: {}'.format(host, e))
+                        hosts.remove(host)
+                        continue
+                    for name in names:
+                        read(host, name)
+                    if names:
+                        host.manifest.save()
+                write(buffer.pop())
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
+        write(buffer.flush())
+    if buffer.late:
+        logging.warning('{} line(s) arrived later than follow lag ({} s) '
+                        'allows'.format(buffer.late, lag))
+    return rows
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(
+        description='Harvest remote logs and reconstruct timeline')
+    parser.add_argument('include', nargs='*',
+                        help='selection pattern(s) for log strings')
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        help='skip log strings with this pattern '
+                             '(may be repeated)')
+    parser.add_argument('-r', '--regex', action='store_true',
+                        help='treat patterns as regular expressions')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=settings.PARALLEL_WORKERS,
+                        help='number of worker processes for refine and '
+                             'parse stages (default: %(default)s)')
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help='keep polling remote logs for new lines after '
+                             'reconstruction')
+    args = parser.parse_args()
+    if not args.include:
         print('Selection pattern for log strings is not defined')
         sys.exit(1)
+    line_filter = filters.LineFilter(args.include, args.exclude, args.regex)
+    hosts = inventory()
 
     print('Reaper is coming')
     # Prepare working directories
-    access_bits = stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO
     print('Preparing working directories... ')
-    if os.path.exists(settings.WORKING_DIR):
-        shutil.rmtree(settings.WORKING_DIR, onerror=rm_readonly)
-        print('Removed {}'.format(settings.WORKING_DIR))
-    os.mkdir(settings.WORKING_DIR, access_bits)
-    print('Created {}'.format(settings.WORKING_DIR))
-    os.mkdir(settings.RAW_DIR, access_bits)
-    print('Created {}'.format(settings.RAW_DIR))
-    os.mkdir(settings.PROCESSED_DIR, access_bits)
-    print('Created {}'.format(settings.PROCESSED_DIR))
+    prepare_dirs(hosts=hosts)
     print('Done')
 
-    # Download log files
-    transport = Transport()
-    print('Connecting to {}@{}:{} ... '.format(settings.USER, settings.HOST,
-                                               settings.PORT), end='')
-    try:
-        transport.connect()
-        print('Success')
-        print('Downloading log files')
-        [print('    {:.<30}...{}'.format(*r)) for r in transport.download()]
-        print('Done')
-    except TransportError as err:
-        print('Failed')
-        print(err)
-    finally:
-        transport.disconnect()
+    # Harvest hosts concurrently
+    new_lines = 0
+    pattern_changed = False
+    print('Harvesting {} host(s)'.format(len(hosts)))
+    with futures.ThreadPoolExecutor(
+            max_workers=min(settings.HOST_WORKERS, len(hosts))) as pool:
+        tasks = {pool.submit(harvest, host, line_filter,
+                             settings.INCREMENTAL or args.follow, args.jobs,
+                             args.follow): host for host in hosts}
+        for task in futures.as_completed(tasks):
+            try:
+                lines, changed, report = task.result()
+            except Exception as err:
+                # One broken host must not abort harvest of the others
+                logging.exception('Harvest of {} failed'.format(tasks[task]))
+                print('Failed to harvest {}: {}'.format(tasks[task], err))
+                continue
+            [print(r) for r in report]
+            new_lines += lines
+            pattern_changed = pattern_changed or changed
+    print('Matches per pattern:')
+    [print('    {:.<30}...{}'.format(*c)) for c in line_filter.counts.items()]
+    if line_filter.exclude:
+        print('    {:.<30}...{}'.format('(excluded)', line_filter.excluded))
 
-    # Filter raw logs
-    print('Will refine harvest: {}'.format(settings.RAW_DIR))
-    raw_logs = os.listdir(settings.RAW_DIR)
-    for raw_log in raw_logs:
-        print('    {:.<30}...'.format(raw_log), end='')
-        source = open(os.path.join(settings.RAW_DIR, raw_log), 'rt')
-        destination = open(os.path.join(settings.PROCESSED_DIR, raw_log), 'wt')
-        [destination.write(line) for line in source if sys.argv[1] in line]
-        destination.close()
-        source.close()
-        print('Done')
-
-    # Delete all empty files from processed directory
-    print('Clean up: delete all empty files from {}'.format(
-        settings.PROCESSED_DIR))
-    processed_logs = os.listdir(settings.PROCESSED_DIR)
-    for file in processed_logs:
-        print('    {:.<30}...'.format(file), end='')
-        if os.path.getsize(os.path.join(settings.PROCESSED_DIR, file)) == 0:
-            os.remove(os.path.join(settings.PROCESSED_DIR, file))
-            print('Deleted')
-        else:
-            print('Skipped')
+    # Delete all empty files from processed directories
+    for host in hosts:
+        print('Clean up: delete all empty files from {}'.format(
+            host.processed_dir))
+        [print('    {:.<30}...{}'.format(*r))
+         for r in clean_up(host.processed_dir)]
 
     # Begin reconstruction
+    connected = [host for host in hosts if host.connected]
+    logs = processed_logs(hosts)
     rfilepath = os.path.join(settings.WORKING_DIR, 'reconstructed.htm')
     print('Will now reconstruct to {}'.format(rfilepath))
-    processed_files = os.listdir(settings.PROCESSED_DIR)
-    if not processed_files:
+    if not logs:
         print('No refined logs are available')
-        sys.exit(2)
-    log_items = list()
-    for processed_file in processed_files:
-        pf = open(os.path.normpath(os.path.join(
-            settings.PROCESSED_DIR, processed_file)), 'rt')
-        for line in pf:
-            for p in settings.compiled_time_patterns:
-                r = p.search(line)
-                if r:
-                    timestamp = datetime.datetime(
-                        int(r.group('year')), int(r.group('month')),
-                        int(r.group('day')), int(r.group('hour')),
-                        int(r.group('min')), int(r.group('sec')),
-                        int(r.group('ms')) * 1000
-                    ).timestamp()
-                    log_items.append(
-                        (timestamp, processed_file, line.replace('\n', '')))
-                    break
-        pf.close()
-    sorted_items = sorted(log_items, key=lambda _item: _item[0])
-    # Open output file
-    reconstructed_file = open(rfilepath, 'wt')
-    reconstructed_file.write("""<!DOCTYPE html>
-<html>
-<body>
-<style type='text/css'>
-  table, td {
-    border: 0px;
-  }
-  table {
-    font-family: sans-serif;
-    font-size: 75%;
-  }
-  td {
-    padding: 5px;
-    text-align: left;
-    vertical-align: top;
-  }
-</style>
-<table>\n""")
-    for item in sorted_items:
-        reconstructed_file.write("""  <tr style='color:black;'>
-    <td>{}</td>
-    <td>{}</td>
-    <td>{}</td>
-  </tr>\n""".format(*item))
-    # Close output file and finish
-    reconstructed_file.write('</table>\n</body>\n</html>\n')
-    reconstructed_file.close()
-    print('Reconstruction completed')
+        if not (args.follow and connected):
+            metrics.registry.export()
+            sys.exit(2)
+    elif not new_lines and not pattern_changed and \
+            os.path.isfile(rfilepath):
+        print('No new data, reconstruction is up to date')
+    else:
+        rows = reconstruct(rfilepath, logs, workers=args.jobs)
+        print('Reconstruction completed: {} rows'.format(rows))
+
+    # Follow remote logs
+    if args.follow and connected:
+        print('Following log files of {} host(s), new lines are appended to '
+              '{} (press Ctrl+C to stop)'.format(len(connected),
+                                                 settings.FOLLOW_FILE))
+        try:
+            rows = follow(connected, line_filter, workers=args.jobs)
+        finally:
+            [host.disconnect() for host in connected]
+        print('Following stopped: {} new line(s)'.format(rows))
+    metrics.registry.export()
+    print('Metrics saved to {}'.format(settings.METRICS_FILE))
     print('Reaper is fading away')
     sys.exit(0)
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""HTML renderer for reconstructed timeline"""
+
+import os
+import html
+import shutil
+import logging
+import datetime
+import itertools
+
+from . import settings
+
+
+HEADER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset='utf-8'>
+<title>{}</title>
+</head>
+<body>
+<style type='text/css'>
+  table, td {{
+    border: 0px;
+  }}
+  table {{
+    font-family: sans-serif;
+    font-size: 75%;
+  }}
+  td {{
+    padding: 5px;
+    text-align: left;
+    vertical-align: top;
+  }}
+</style>
+"""
+FOOTER = '</body>\n</html>\n'
+ROW = """  <tr style='color:black;'>
+    <td>{}</td>
+    <td>{}</td>
+    <td>{}</td>
+  </tr>
+"""
+LINK = "<a href='{}'>{}</a>"
+
+
+def format_time(timestamp):
+    """Get human-readable local time
+
+    :param timestamp: POSIX timestamp
+
+    :return: time string with milliseconds
+    """
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+class HtmlRenderer:
+    """Streaming renderer of timeline records to HTML.
+
+    Records are written in batches through a buffered file. If there are
+    more records than fit in one page, they are split into pages stored in
+    a directory next to output file, and output file becomes an index with
+    time range of every page. Memory usage is limited by two pages.
+    """
+
+    def __init__(self, path, page_size=settings.PAGE_SIZE,
+                 batch_size=settings.RENDER_BATCH):
+        """
+        :param path: output file path
+        :param page_size: number of records per page
+        :param batch_size: number of records formatted per write
+        """
+        self.path = path
+        self.pages_dir = os.path.splitext(path)[0]
+        self.page_size = int(page_size)
+        self.batch_size = int(batch_size)
+
+    @staticmethod
+    def _page_name(n):
+        """Get file name of n-th page (zero-based)"""
+        return 'page-{:04d}.htm'.format(n + 1)
+
+    def _write_rows(self, f, items):
+        """Write records as table rows in batches"""
+        f.write('<table>\n')
+        for i in range(0, len(items), self.batch_size):
+            f.write(''.join(ROW.format(
+                timestamp, html.escape(name), html.escape(line))
+                for timestamp, name, line in items[i:i + self.batch_size]))
+        f.write('</table>\n')
+
+    def _write_page(self, n, items, last):
+        """Write one page with navigation links"""
+        links = [LINK.format(
+            '../{}'.format(os.path.basename(self.path)), 'Index')]
+        if n:
+            links.insert(0, LINK.format(self._page_name(n - 1), 'Previous'))
+        if not last:
+            links.append(LINK.format(self._page_name(n + 1), 'Next'))
+        navigation = '<p>{}</p>\n'.format(' | '.join(links))
+        with open(os.path.join(self.pages_dir, self._page_name(n)), 'wt',
+                  encoding='utf-8', buffering=2**20) as f:
+            f.write(HEADER.format('Page {}'.format(n + 1)))
+            f.write(navigation)
+            self._write_rows(f, items)
+            f.write(navigation)
+            f.write(FOOTER)
+
+    def _write_index(self, pages):
+        """Write index page with time range of every page"""
+        with open(self.path, 'wt', encoding='utf-8') as f:
+            f.write(HEADER.format('Reconstructed timeline'))
+            f.write('<table>\n')
+            for n, (first, last, rows) in enumerate(pages):
+                f.write(ROW.format(
+                    LINK.format('{}/{}'.format(
+                        os.path.basename(self.pages_dir), self._page_name(n)),
+                        'Page {}'.format(n + 1)),
+                    '{} &mdash; {}'.format(format_time(first),
+                                           format_time(last)),
+                    '{} rows'.format(rows)))
+            f.write('</table>\n')
+            f.write(FOOTER)
+
+    def render(self, items):
+        """Write records to HTML
+
+        :param items: records (timestamp, log name, line) in output order
+
+        :return: number of written records
+        """
+        if os.path.isdir(self.pages_dir):
+            shutil.rmtree(self.pages_dir)
+        items = iter(items)
+        page = list(itertools.islice(items, self.page_size))
+        next_page = list(itertools.islice(items, self.page_size))
+        if not next_page:
+            with open(self.path, 'wt', encoding='utf-8',
+                      buffering=2**20) as f:
+                f.write(HEADER.format('Reconstructed timeline'))
+                self._write_rows(f, page)
+                f.write(FOOTER)
+            logging.info('Rendered {} rows to {}'.format(len(page),
+                                                         self.path))
+            return len(page)
+        os.mkdir(self.pages_dir)
+        pages = []
+        while page:
+            self._write_page(len(pages), page, not next_page)
+            pages.append((page[0][0], page[-1][0], len(page)))
+            page = next_page
+            next_page = list(itertools.islice(items, self.page_size))
+        self._write_index(pages)
+        rows = sum(p[2] for p in pages)
+        logging.info('Rendered {} rows to {} pages in {}'.format(
+            rows, len(pages), self.pages_dir))
+        return rows
@@ -8,6 +8,15 @@ HOST = 'testhost'
 PORT = 22
 USER = ''
 PASSWORD = ''
+SSH_COMPRESSION = False  # Compress SSH transport (helps on slow links)
+
+# Host inventory for multi-host harvest: list of dicts with 'name' (unique,
+# used to tag host logs in timeline) and optional 'host', 'port', 'user',
+# 'password', 'remote_dir', 'mask' and 'skew' (number of seconds host clock
+# is ahead of reference clock); missing values are taken from single host
+# settings. Empty inventory means single host harvest from HOST.
+HOSTS = []
+HOST_WORKERS = 8  # Number of hosts harvested concurrently
 
 # Working directories
 if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
@@ -20,8 +29,46 @@ WORKING_DIR = os.path.normpath(os.path.join(HOME, 'harvest'))
 RAW_DIR = os.path.normpath(os.path.join(WORKING_DIR, 'raw'))
 PROCESSED_DIR = os.path.normpath(os.path.join(WORKING_DIR, 'processed'))
 REMOTE_DIR = ''
+MANIFEST = os.path.normpath(os.path.join(WORKING_DIR, 'manifest.json'))
+TIMELINE_DIR = os.path.normpath(os.path.join(WORKING_DIR, 'timeline'))
+
+# Keep working directory between runs and fetch only appended data
+INCREMENTAL = True
+
+# Rotated and compressed (gzip, xz) logs are matched too
+LOGFILE_MASK = r'[a-zA-Z_-]*.log(\.[0-9]+)?(\.gz|\.xz)?$'
+
+# Download settings
+DOWNLOAD_WORKERS = 4  # Number of SFTP channels used concurrently
+DOWNLOAD_CHUNK = 2**20  # Size of a single read from remote file, bytes
+
+# Number of lines per log file held in memory to put slightly out-of-order
+# lines in place during reconstruction
+REORDER_WINDOW = 1000
+
+# Number of worker processes for refine and parse stages (1 = serial) and
+# approximate size of raw log part handed to a worker, bytes
+PARALLEL_WORKERS = 1
+PARALLEL_CHUNK = 2**26
+
+# Number of rows per page of reconstructed timeline and number of rows
+# written at once
+PAGE_SIZE = 10000
+RENDER_BATCH = 1000
+
+# Filter remote logs while reading them instead of storing raw copies
+STREAMING = False
+
+# Follow mode: interval of polling remote logs for new data and holding time
+# of new lines for reordering, seconds; merged lines are appended to file
+FOLLOW_INTERVAL = 2
+FOLLOW_LAG = 3
+FOLLOW_FILE = os.path.normpath(os.path.join(WORKING_DIR, 'followed.log'))
 
-LOGFILE_MASK = '[a-zA-Z_-]*.log$'
+# Run metrics: JSON summary and optional Prometheus textfile (e.g. in node
+# exporter textfile collector directory, None = not written)
+METRICS_FILE = os.path.normpath(os.path.join(WORKING_DIR, 'metrics.json'))
+PROMETHEUS_FILE = None
 
 TIME_PATTERNS = (
     '(?P<day>\d\d)-(?P<month>\d\d)-(?P<year>\d{4}).'
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Local read-only SFTP server for benchmarks and experiments.
+
+Server listens on loopback interface, accepts any user name and password
+and serves files of one local directory. It is not meant to be exposed to
+network.
+"""
+
+import os
+import socket
+import logging
+import threading
+import paramiko
+
+
+class _Server(paramiko.ServerInterface):
+    """SSH server accepting any password"""
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class _Handle(paramiko.SFTPHandle):
+    """Handle of file opened for reading"""
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """Read-only SFTP interface to root directory"""
+
+    def __init__(self, server, root, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self._root = root
+
+    def _local(self, path):
+        """Map remote path to local path inside root directory"""
+        return os.path.join(self._root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path).replace(os.sep, '/')
+
+    def list_folder(self, path):
+        try:
+            local = self._local(path)
+            attrs = []
+            for name in os.listdir(local):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(local, name)))
+                attr.filename = name
+                attrs.append(attr)
+            return attrs
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self._local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            f = open(self._local(path), 'rb')
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = f
+        return handle
+
+
+class LocalSFTPServer:
+    """SFTP stand-in serving local directory on loopback interface"""
+
+    def __init__(self, root, port=0):
+        """
+        :param root: directory to serve
+        :param port: port to listen on (default = 0, any free port)
+        """
+        self.root = os.path.abspath(root)
+        self.host = '127.0.0.1'
+        self._key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, port))
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        self._thread = None
+
+    def _serve(self):
+        """Accept connections until socket is closed"""
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self._key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, _SFTPServer, self.root)
+            try:
+                transport.start_server(server=_Server())
+            except paramiko.SSHException as e:
+                logging.warning('SFTP stub: failed to start session: '
+                                '{}'.format(e))
+                continue
+            self._transports.append(transport)
+
+    def start(self):
+        """Start serving in background thread
+        """
+        self._socket.listen(16)
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        logging.info('SFTP stub: serving {} on {}:{}'.format(
+            self.root, self.host, self.port))
+
+    def stop(self):
+        """Close listening socket and all sessions
+        """
+        try:
+            # Wake up thread blocked in accept()
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+        if self._thread is not None:
+            self._thread.join()
+        logging.info('SFTP stub: stopped')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
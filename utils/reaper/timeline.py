@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Persistent time-indexed store for reconstructed timeline.
+
+Timeline directory contains:
+
+- ``lines.dat`` - line texts (UTF-8, one per line) in time order;
+- ``timestamps.bin``, ``files.bin``, ``offsets.bin`` - index columns:
+  fixed-width arrays (native byte order) with timestamp (double), log id
+  (unsigned int) and offset of the line in ``lines.dat`` (unsigned long
+  long) of every record;
+- ``files.json`` - list of log names, log id is a position in the list.
+
+Index is sorted by time, so time windows are found with binary search over
+memory-mapped timestamps column without reading anything else.
+"""
+
+import os
+import sys
+import mmap
+import json
+import array
+import bisect
+import shutil
+import logging
+import datetime
+
+from . import settings
+
+
+COLUMNS = (('timestamps.bin', 'd'), ('files.bin', 'I'), ('offsets.bin', 'Q'))
+LINES = 'lines.dat'
+FILES = 'files.json'
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%H:%M:%S.%f', '%H:%M:%S', '%H:%M')
+
+
+class TimelineWriter:
+    """Writer of timeline store.
+    Store is written to temporary directory, which replaces previous store
+    on close.
+    """
+
+    def __init__(self, path=settings.TIMELINE_DIR,
+                 batch_size=settings.RENDER_BATCH):
+        """
+        :param path: timeline directory path
+        :param batch_size: number of records buffered before writing
+        """
+        self.path = os.path.normpath(path)
+        self._tmp_path = self.path + '.tmp'
+        if os.path.isdir(self._tmp_path):
+            shutil.rmtree(self._tmp_path)
+        os.mkdir(self._tmp_path)
+        self._batch_size = batch_size
+        self._columns = [(open(os.path.join(self._tmp_path, name), 'wb'),
+                          array.array(code)) for name, code in COLUMNS]
+        self._lines = open(os.path.join(self._tmp_path, LINES), 'wb',
+                           buffering=2**20)
+        self._offset = 0
+        self._files = dict()
+        self.records = 0
+
+    def add(self, timestamp, name, line):
+        """Append record; records must be added in time order
+
+        :param timestamp: POSIX timestamp
+        :param name: log name
+        :param line: line text
+        """
+        file_id = self._files.setdefault(name, len(self._files))
+        data = line.encode(errors='replace') + b'\n'
+        for (_, column), value in zip(self._columns,
+                                      (timestamp, file_id, self._offset)):
+            column.append(value)
+        self._lines.write(data)
+        self._offset += len(data)
+        self.records += 1
+        if len(self._columns[0][1]) >= self._batch_size:
+            self._flush()
+
+    def _flush(self):
+        """Write buffered index records"""
+        for f, column in self._columns:
+            column.tofile(f)
+            del column[:]
+
+    def close(self):
+        """Finish writing and replace previous store
+        """
+        self._flush()
+        for f, _ in self._columns:
+            f.close()
+        self._lines.close()
+        with open(os.path.join(self._tmp_path, FILES), 'wt') as f:
+            json.dump(sorted(self._files, key=self._files.get), f)
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self._tmp_path, self.path)
+        logging.info('Timeline saved: {} ({} records)'.format(
+            self.path, self.records))
+
+    def abort(self):
+        """Stop writing and keep previous store
+        """
+        for f, _ in self._columns:
+            f.close()
+        self._lines.close()
+        shutil.rmtree(self._tmp_path, ignore_errors=True)
+        logging.warning('Timeline was not saved: {}'.format(self.path))
+
+    def tee(self, items):
+        """Store records while passing them through.
+        Store is replaced only if all records have been passed.
+
+        :param items: records (timestamp, log name, line) in time order
+
+        :return: the same records
+        """
+        completed = False
+        try:
+            for item in items:
+                self.add(*item)
+                yield item
+            completed = True
+        finally:
+            if completed:
+                self.close()
+            else:
+                self.abort()
+
+
+class Timeline:
+    """Read-only access to timeline store"""
+
+    def __init__(self, path=settings.TIMELINE_DIR):
+        """Open timeline store
+
+        :param path: timeline directory path
+
+        :raise FileNotFoundError if store does not exist
+        """
+        self.path = os.path.normpath(path)
+        with open(os.path.join(self.path, FILES), 'rt') as f:
+            self.files = json.load(f)
+        self._maps = []
+        self._columns = []
+        for name, code in COLUMNS + ((LINES, 'B'),):
+            with open(os.path.join(self.path, name), 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._maps.append(mm)
+                    self._columns.append(memoryview(mm).cast(code))
+                else:
+                    self._columns.append(array.array(code))
+        self._timestamps, self._file_ids, self._offsets, self._lines = \
+            self._columns
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def close(self):
+        """Release memory maps
+        """
+        for view in self._columns:
+            if isinstance(view, memoryview):
+                view.release()
+        for mm in self._maps:
+            mm.close()
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def bounds(self):
+        """Get time range of the timeline
+
+        :return: tuple with first and last timestamp or None if empty
+        """
+        if not len(self):
+            return None
+        return self._timestamps[0], self._timestamps[-1]
+
+    def record(self, n):
+        """Get n-th record
+
+        :param n: record number
+
+        :return: tuple with timestamp, log name and line
+        """
+        start = self._offsets[n]
+        end = self._offsets[n + 1] if n + 1 < len(self) else len(self._lines)
+        return (self._timestamps[n], self.files[self._file_ids[n]],
+                self._lines[start:end - 1].tobytes().decode())
+
+    def query(self, start=None, end=None):
+        """Get records within time window
+
+        :param start: window start, POSIX timestamp (inclusive)
+        :param end: window end, POSIX timestamp (exclusive)
+
+        :return: records (timestamp, log name, line) in time order
+        """
+        first = 0 if start is None else \
+            bisect.bisect_left(self._timestamps, start)
+        last = len(self) if end is None else \
+            bisect.bisect_left(self._timestamps, end)
+        for n in range(first, last):
+            yield self.record(n)
+
+
+def parse_time(text, day=None):
+    """Convert local time string to POSIX timestamp
+
+    :param text: date and time or time only (see TIME_FORMATS)
+    :param day: date to use if text contains time only
+
+    :return: POSIX timestamp
+
+    :raise ValueError if text does not match any format
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            t = datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+        if '%Y' not in time_format and day is not None:
+            t = datetime.datetime.combine(day, t.time())
+        return t.timestamp()
+    raise ValueError('Unknown time format: {}'.format(text))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('Usage: timeline.py START END')
+        print('    START, END - local time: [YYYY-MM-DD ]HH:MM[:SS[.ffffff]]')
+        sys.exit(1)
+    try:
+        timeline = Timeline()
+    except FileNotFoundError:
+        print('Timeline is not available: {}'.format(settings.TIMELINE_DIR))
+        sys.exit(2)
+    with timeline:
+        if not len(timeline):
+            sys.exit(0)
+        first_day = datetime.datetime.fromtimestamp(timeline.bounds()[0])
+        try:
+            window = [parse_time(t, first_day.date()) for t in sys.argv[1:3]]
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        for timestamp, name, line in timeline.query(*window):
+            print('{:<20} {}'.format(name, line))
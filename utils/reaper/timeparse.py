@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Timestamp extraction engine for reaper"""
+
+import re
+import datetime
+import collections
+
+from . import settings
+
+
+DATE_FIELDS = ('year', 'month', 'day', 'hour', 'min')
+EPOCH_CACHE_SIZE = 2**17  # Number of cached minutes per time pattern
+
+# Epoch seconds of minute start, cached per time pattern and shared between
+# parsers: {pattern: {date text or tuple with date fields: seconds}}
+_epochs = collections.defaultdict(dict)
+_variable_width = re.compile(r'[*+?|]|\{\d*,')
+
+
+def _layout(match):
+    """Find fixed positions of timestamp fields in pattern match
+
+    :param match: match of time pattern
+
+    :return: tuple with match width, date prefix length, start and end of
+             'sec' and 'ms' fields (relative to match start) or None if
+             pattern has variable width or date fields do not go first
+    """
+    pattern = match.re.pattern
+    if _variable_width.search(re.sub(r'\(\?P<\w+>', '(', pattern)):
+        return None
+    start = match.start()
+    date_end = max(match.end(f) for f in DATE_FIELDS) - start
+    if min(match.start('sec'), match.start('ms')) - start < date_end:
+        return None
+    return (match.end() - start, date_end,
+            match.start('sec') - start, match.end('sec') - start,
+            match.start('ms') - start, match.end('ms') - start)
+
+
+class TimestampParser:
+    """Single pass timestamp extractor.
+
+    All time patterns are compiled in one alternation, so a line is scanned
+    once whatever the number of patterns is. First found pattern and its
+    position in line are pinned: next lines of the same log are checked
+    with anchored match of pinned pattern only. For fixed width patterns
+    fields are sliced at known positions without regex at all. Epoch
+    seconds are calculated once per minute and cached.
+    """
+
+    def __init__(self, patterns=settings.TIME_PATTERNS):
+        """
+        :param patterns: time patterns with named groups 'year', 'month',
+                         'day', 'hour', 'min', 'sec' and 'ms'
+        """
+        self._patterns = [re.compile(p) for p in patterns]
+        self.failures = 0  # Number of lines without valid timestamp
+        self._combined = re.compile('|'.join(
+            '(?P<_{0}>{1})'.format(
+                n, re.sub(r'\(\?P<(\w+)>', r'(?P<\g<1>_{}>'.format(n), p))
+            for n, p in enumerate(patterns)))
+        self.reset()
+
+    def reset(self):
+        """Forget pinned pattern (call before parsing another log)
+        """
+        self._pattern = None
+        self._offset = 0
+        self._layout = None
+        self._epochs = None
+
+    def _detect(self, line):
+        """Search all patterns in line and pin found one
+
+        :param line: log line
+
+        :return: match of pinned pattern or None
+        """
+        m = self._combined.search(line)
+        if m is None:
+            return None
+        for n, pattern in enumerate(self._patterns):
+            if m.group('_{}'.format(n)) is not None:
+                break
+        m = pattern.match(line, m.start())
+        self._pattern = pattern
+        self._offset = m.start()
+        self._layout = _layout(m)
+        self._epochs = _epochs[pattern.pattern]
+        return m
+
+    def _timestamp(self, m):
+        """Calculate timestamp from pattern match
+
+        :param m: match of pinned pattern
+
+        :return: POSIX timestamp or None if date is not valid
+        """
+        if self._layout is not None:
+            key = m.string[m.start():m.start() + self._layout[1]]
+        else:
+            key = m.group(*DATE_FIELDS)
+        base = self._epochs.get(key)
+        if base is None:
+            try:
+                base = int(datetime.datetime(
+                    *[int(m.group(f)) for f in DATE_FIELDS]).timestamp())
+            except (ValueError, OverflowError):
+                return None
+            if len(self._epochs) >= EPOCH_CACHE_SIZE:
+                self._epochs.clear()
+            self._epochs[key] = base
+        sec = int(m.group('sec'))
+        if sec > 59:
+            return None
+        return base + sec + int(m.group('ms')) / 1000
+
+    def parse(self, line):
+        """Get timestamp of log line
+
+        :param line: log line
+
+        :return: POSIX timestamp or None if line has no valid timestamp
+        """
+        layout = self._layout
+        if layout is not None:
+            text = line[self._offset:self._offset + layout[0]]
+            base = self._epochs.get(text[:layout[1]])
+            if base is not None:
+                sec = text[layout[2]:layout[3]]
+                ms = text[layout[4]:layout[5]]
+                if sec.isdecimal() and ms.isdecimal():
+                    sec = int(sec)
+                    if sec <= 59:
+                        return base + sec + int(ms) / 1000
+        m = None
+        if self._pattern is not None:
+            m = self._pattern.match(line, self._offset)
+        if m is None:
+            m = self._detect(line)
+            if m is None:
+                self.failures += 1
+                return None
+        timestamp = self._timestamp(m)
+        if timestamp is None:
+            self.failures += 1
+        return timestamp
+
+
+def decode(raw):
+    """Decode raw log line
+
+    :param raw: line bytes
+
+    :return: line text without line break
+    """
+    return raw.rstrip(b'\r\n').decode(errors='replace')
+
+
+def scan(path, parser=None):
+    """Read timestamped lines from log file
+
+    :param path: log file path
+    :param parser: timestamp parser (default = new TimestampParser)
+
+    :return: tuple with timestamp, line offset in file and line text
+    """
+    if parser is None:
+        parser = TimestampParser()
+    offset = 0
+    with open(path, 'rb') as f:
+        for raw in f:
+            line = decode(raw)
+            timestamp = parser.parse(line)
+            if timestamp is not None:
+                yield timestamp, offset, line
+            offset += len(raw)
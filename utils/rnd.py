@@ -1,4 +1,26 @@
+import os
+import sys
+import array
 import random
+import functools
+import threading
+import collections.abc
+from typing import Optional
+
+
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def printable_codepoints() -> array.array:
+    """Get table of non-space printable unicode characters. Table is built
+    on first call and cached.
+
+    :return: array of codepoints
+    :rtype: array.array
+    """
+    return array.array('I', [c for c in range(0x110000)
+                             if chr(c).isprintable() and not chr(c).isspace()])
 
 
 def random_char() -> str:
@@ -7,11 +29,8 @@ def random_char() -> str:
     :return: non-space printable unicode character
     :rtype: str
     """
-    random.seed()
-    while True:
-        char = chr(random.randint(0, 0x10FFFF))
-        if char.isprintable() and not char.isspace():
-            return char
+    table = printable_codepoints()
+    return chr(table[_rng().randrange(len(table))])
 
 
 def random_str(length: int = 9) -> str:
@@ -23,7 +42,25 @@ def random_str(length: int = 9) -> str:
     :return: string with random UTF-8 characters
     :rtype: str
     """
-    return ''.join([random_char() for _ in range(length)])
+    return random_strs(1, length)[0]
+
+
+def random_strs(number: int, length: int = 9) -> list:
+    """Get batch of strings with random UTF-8 characters.
+
+    :param number: number of strings
+    :type number: int
+    :param length: length of every string (default = 9)
+    :type length: int
+
+    :return: list of strings with random UTF-8 characters
+    :rtype: list
+    """
+    codepoints = array.array('I', _rng().choices(printable_codepoints(),
+                                                 k=number * length))
+    # Decode all characters at once as UTF-32 in native byte order
+    text = codepoints.tobytes().decode('utf-32-' + sys.byteorder[0] + 'e')
+    return [text[n * length:(n + 1) * length] for n in range(number)]
 
 
 def random_numstr(length: int = 9) -> str:
@@ -35,8 +72,47 @@ def random_numstr(length: int = 9) -> str:
     :return: string with digits
     :rtype: str
     """
-    random.seed()
-    return ''.join([str(random.randint(0, 9)) for _ in range(length)])
+    return _numstr(_rng(), length)
+
+
+def random_numstrs(number: int, length: int = 9,
+                   unique: bool = False) -> list:
+    """Get batch of strings with digits.
+
+    :param number: number of strings
+    :type number: int
+    :param length: length of every string (default = 9)
+    :type length: int
+    :param unique: all strings differ (default = False)
+    :type unique: bool
+
+    :return: list of strings with digits
+    :rtype: list
+
+    :raise ValueError if there are fewer unique strings than requested
+    """
+    return list(iter_numstrs(number, length, unique))
+
+
+def iter_numstrs(number: Optional[int] = None, length: int = 9,
+                 unique: bool = False) -> collections.abc.Iterator:
+    """Get generator of strings with digits.
+
+    :param number: number of strings (default = None, endless)
+    :type number: Optional[int]
+    :param length: length of every string (default = 9)
+    :type length: int
+    :param unique: all strings differ; endless generator stops when all
+                   strings of given length are used (default = False)
+    :type unique: bool
+
+    :return: generator of strings with digits
+    :rtype: collections.abc.Iterator
+
+    :raise ValueError if there are fewer unique strings than requested
+    """
+    return _generate(lambda rng: _numstr(rng, length), number, unique,
+                     10 ** length)
 
 
 def random_session_id() -> str:
@@ -45,10 +121,112 @@ def random_session_id() -> str:
     :return: session ID
     :rtype: str
     """
-    random.seed()
-    chars = ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9',
-             'a', 'b', 'c', 'd', 'e', 'f')
-    parts = []
-    for i in (8, 4, 4, 4, 12):
-        parts.append(''.join([random.choice(chars) for _ in range(i)]))
-    return '-'.join(parts)
+    return _session_id(_rng())
+
+
+def random_session_ids(number: int, unique: bool = False) -> list:
+    """Generate batch of random session IDs.
+
+    :param number: number of session IDs
+    :type number: int
+    :param unique: all session IDs differ (default = False)
+    :type unique: bool
+
+    :return: list of session IDs
+    :rtype: list
+    """
+    return list(iter_session_ids(number, unique))
+
+
+def iter_session_ids(number: Optional[int] = None,
+                     unique: bool = False) -> collections.abc.Iterator:
+    """Get generator of random session IDs.
+
+    :param number: number of session IDs (default = None, endless)
+    :type number: Optional[int]
+    :param unique: all session IDs differ (default = False)
+    :type unique: bool
+
+    :return: generator of session IDs
+    :rtype: collections.abc.Iterator
+    """
+    return _generate(_session_id, number, unique, 2 ** 128)
+
+
+def _rng() -> random.Random:
+    """Get random generator of current thread. Generator is seeded from
+    system entropy once per thread and process, so calls do not reseed.
+
+    :return: random generator
+    :rtype: random.Random
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.rng = random.Random()
+        _local.pid = os.getpid()
+    return _local.rng
+
+
+def _numstr(rng: random.Random, length: int) -> str:
+    """Make string with digits from 18-digit random numbers.
+
+    :param rng: random generator
+    :type rng: random.Random
+    :param length: string's length
+    :type length: int
+
+    :return: string with digits
+    :rtype: str
+    """
+    return ''.join(['{:018d}'.format(rng.randrange(10 ** 18))
+                    for _ in range(-(-length // 18))])[:length]
+
+
+def _session_id(rng: random.Random) -> str:
+    """Make session ID from 128 random bits.
+
+    :param rng: random generator
+    :type rng: random.Random
+
+    :return: session ID
+    :rtype: str
+    """
+    h = '{:032x}'.format(rng.getrandbits(128))
+    return '-'.join((h[:8], h[8:12], h[12:16], h[16:20], h[20:]))
+
+
+def _generate(make, number: Optional[int], unique: bool,
+              space: int) -> collections.abc.Iterator:
+    """Get generator of values.
+
+    :param make: function making one value with given random generator
+    :param number: number of values (None for endless generator)
+    :type number: Optional[int]
+    :param unique: skip repeated values
+    :type unique: bool
+    :param space: number of possible values
+    :type space: int
+
+    :return: generator of values
+    :rtype: collections.abc.Iterator
+
+    :raise ValueError if there are fewer possible values than requested
+    """
+    if unique and number is not None and number > space:
+        raise ValueError('Can not make {} unique values, only {} are '
+                         'possible'.format(number, space))
+
+    def generate():
+        rng = _rng()
+        seen = set()
+        count = 0
+        while number is None or count < number:
+            value = make(rng)
+            if unique:
+                if value in seen:
+                    if len(seen) >= space:
+                        return
+                    continue
+                seen.add(value)
+            count += 1
+            yield value
+    return generate()